@@ -1,9 +1,42 @@
-from django.contrib import admin
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections
 from django.utils.html import format_html
 from django.utils import timezone
 
 from . import models
-from .settings import PAYPAL_SUBS_WEBHOOK_ID
+from .settings import PAYPAL_SUBS_ADMIN_ACTION_WORKERS, PAYPAL_SUBS_WEBHOOK_ID
+
+
+def run_concurrently(modeladmin, request, queryset, func, done):
+    """
+    Calls func(obj) for every object in queryset, in a pool of
+    PAYPAL_SUBS_ADMIN_ACTION_WORKERS threads, and reports how many
+    succeeded ("<done> N objects") and which failed with message_user.
+    """
+    def call(obj):
+        try:
+            func(obj)
+        except Exception as e:
+            return "%s: %s" % (obj, e)
+        finally:
+            # Each thread has its own db connection
+            connections.close_all()
+
+    objs = list(queryset)
+    with ThreadPoolExecutor(max_workers=max(PAYPAL_SUBS_ADMIN_ACTION_WORKERS, 1)) as executor:
+        errors = [error for error in executor.map(call, objs) if error]
+
+    modeladmin.message_user(request, "%s %d of %d objects." % (
+        done, len(objs) - len(errors), len(objs)
+    ))
+    if errors:
+        modeladmin.message_user(
+            request, "Failed: " + "; ".join(errors), level=messages.ERROR
+        )
 
 
 class BasePaypalModelAdmin(admin.ModelAdmin):
@@ -36,13 +69,12 @@ class BasePaypalModelAdmin(admin.ModelAdmin):
 
 @admin.register(models.BillingPlan)
 class BillingPlanAdmin(BasePaypalModelAdmin):
-    list_display = ("state", "type", "create_time")
+    list_display = ("state", "type", "display_price", "create_time")
     list_filter = ("type", "state", "create_time", "update_time")
     raw_id_fields = ("payment_definitions", )
 
     def activate_plans(self, request, queryset):
-        for obj in queryset:
-            obj.activate()
+        run_concurrently(self, request, queryset, lambda obj: obj.activate(), "Activated")
 
     actions = (activate_plans, )
 
@@ -54,19 +86,25 @@ class BillingAgreementAdmin(BasePaypalModelAdmin):
     raw_id_fields = ("user", "payer_model")
 
     def cancel(self, request, queryset):
-        for agreement in queryset:
-            agreement.cancel(note="Cancelled by admin", immediately=False)
+        run_concurrently(
+            self, request, queryset,
+            lambda agreement: agreement.cancel(note="Cancelled by admin", immediately=False),
+            "Cancelled"
+        )
     cancel.short_description = "Cancel selected agreements at end of billing period"
 
     def cancel_immediately(self, request, queryset):
-        for agreement in queryset:
-            agreement.cancel(note="Cancelled by admin", immediately=True)
+        run_concurrently(
+            self, request, queryset,
+            lambda agreement: agreement.cancel(note="Cancelled by admin", immediately=True),
+            "Cancelled"
+        )
     cancel_immediately.short_description = "Cancel selected agreements immediately"
 
     def expire(self, request, queryset):
-        for agreement in queryset:
-            agreement.end_of_period = timezone.now()
-            agreement.save()
+        count = queryset.update(end_of_period=timezone.now())
+        models.Entitlement.objects.refresh(*queryset)
+        self.message_user(request, "Expired %d agreements." % (count))
     expire.short_description = "Mark selected agreements as expired"
 
     actions = (cancel, cancel_immediately, expire)
@@ -104,6 +142,20 @@ class DisputeAdmin(BasePaypalModelAdmin):
     )
 
 
+@admin.register(models.Entitlement)
+class EntitlementAdmin(admin.ModelAdmin):
+    list_display = (
+        "__str__", "user", "plan_id", "source", "is_active", "active_until", "livemode",
+    )
+    list_filter = ("source", "is_active", "livemode")
+    raw_id_fields = ("user", )
+    readonly_fields = ("created", "updated")
+    search_fields = ("source_id", "plan_id")
+
+    def has_add_permission(self, request):
+        return False
+
+
 @admin.register(models.Payer)
 class PayerAdmin(admin.ModelAdmin):
     list_display = (
@@ -206,6 +258,30 @@ class SubscriptionAdmin(BasePaypalModelAdmin):
     raw_id_fields = ('plan', )
 
 
+@admin.register(models.SyncState)
+class SyncStateAdmin(admin.ModelAdmin):
+    list_display = (
+        "__str__", "model", "livemode", "watermark", "last_synced", "last_synced_count",
+    )
+    list_filter = ("model", "livemode")
+    readonly_fields = ("created", "updated")
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(models.SweepState)
+class SweepStateAdmin(admin.ModelAdmin):
+    list_display = (
+        "__str__", "name", "livemode", "watermark", "last_swept", "last_swept_count",
+    )
+    list_filter = ("name", "livemode")
+    readonly_fields = ("created", "updated")
+
+    def has_add_permission(self, request):
+        return False
+
+
 @admin.register(models.WebhookEvent)
 class WebhookEventAdmin(BasePaypalModelAdmin):
     list_display = ("event_type", "resource_type", "resource_id_link", "create_time", )
@@ -217,10 +293,25 @@ class WebhookEventAdmin(BasePaypalModelAdmin):
     )
     search_fields = ("resource_id", )
 
+    class WebhookEventChangeList(ChangeList):
+        def get_results(self, request):
+            super().get_results(request)
+            # Resolve the linked resources of the whole page at once
+            models.WebhookEvent.prefetch_resources(self.result_list)
+
+    def get_changelist(self, request, **kwargs):
+        return self.WebhookEventChangeList
+
     def resource_id_link(self, obj):
+        try:
+            resource = obj.get_resource()
+        except ObjectDoesNotExist:
+            resource = None
+        if resource is None:
+            return obj.resource_id
         return format_html(
             '<strong><a href="{}">{}</a></strong>',
-            obj.get_resource().admin_url,
+            resource.admin_url,
             obj.resource_id,
         )
     resource_id_link.short_description = "Resource Id"
@@ -229,16 +320,20 @@ class WebhookEventAdmin(BasePaypalModelAdmin):
 @admin.register(models.WebhookEventTrigger)
 class WebhookEventTriggerAdmin(admin.ModelAdmin):
     list_display = (
-        "created", "updated", "valid", "processed", "exception", "webhook_event",
+        "created", "updated", "valid", "processed", "queued", "attempts",
+        "exception", "webhook_event",
     )
-    list_filter = ("created", "valid", "processed", )
+    list_filter = ("created", "valid", "processed", "queued", )
     raw_id_fields = ("webhook_event", )
+    search_fields = ("transmission_id", )
 
     def reverify(self, request, queryset):
-        for trigger in queryset:
+        def verify(trigger):
             if trigger.verify(webhook_id=PAYPAL_SUBS_WEBHOOK_ID):
                 trigger.valid = True
-                trigger.save()
+                trigger.save(update_fields=["valid", "updated"])
+
+        run_concurrently(self, request, queryset, verify, "Reverified")
 
     def reprocess(self, request, queryset):
         for trigger in queryset:
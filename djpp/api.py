@@ -1,43 +1,298 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from django.conf import settings
+from django.core.cache import caches
 from django.utils.decorators import classproperty
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .constants import APIMODE_SANDBOX, APIMODE_LIVE
 from .settings import (
     PAYPAL_SUBS_CLIENT_ID, PAYPAL_SUBS_SECRET,
     PAYPAL_SUBS_API_BASE_URL_SANDBOX, PAYPAL_SUBS_API_BASE_URL_LIVE, PAYPAL_SUBS_API_BASE_URL,
+    PAYPAL_SUBS_API_POOL_SIZE, PAYPAL_SUBS_API_TIMEOUT,
+    PAYPAL_SUBS_API_MAX_RETRIES, PAYPAL_SUBS_API_RETRY_BACKOFF,
+    PAYPAL_SUBS_LIVEMODE, PAYPAL_SUBS_TOKEN_REFRESH_MARGIN, PAYPAL_SUBS_TOKEN_CACHE,
+    PAYPAL_SUBS_TOKEN_DEFAULT_TTL, PAYPAL_SUBS_TOKEN_LOCK_TIMEOUT,
 )
 
 
+def resolve_mode(mode='settings'):
+    '''Turns the 'settings' pseudo-mode into APIMODE_LIVE or APIMODE_SANDBOX'''
+    if mode == 'settings':
+        return APIMODE_LIVE if PAYPAL_SUBS_LIVEMODE is True else APIMODE_SANDBOX
+    return mode
+
+
+class PaypalSessionPool(object):
+    '''
+    Keeps one keep-alive requests.Session per API base url (sandbox/live),
+    so consecutive API calls reuse already established TCP+TLS connections
+    instead of doing a fresh handshake on every request.
+
+    Sessions are created lazily and shared between threads; the underlying
+    urllib3 connection pool is thread-safe and holds up to `pool_size`
+    connections per host.
+    '''
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=PAYPAL_SUBS_API_POOL_SIZE, timeout=PAYPAL_SUBS_API_TIMEOUT,
+                 max_retries=PAYPAL_SUBS_API_MAX_RETRIES, backoff=PAYPAL_SUBS_API_RETRY_BACKOFF):
+        self.pool_size   = pool_size
+        self.timeout     = timeout
+        self.max_retries = max_retries
+        self.backoff     = backoff
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def base_url(mode='settings'):
+        if mode == 'settings':
+            return PAYPAL_SUBS_API_BASE_URL
+        elif mode == APIMODE_SANDBOX:
+            return PAYPAL_SUBS_API_BASE_URL_SANDBOX
+        elif mode == APIMODE_LIVE:
+            return PAYPAL_SUBS_API_BASE_URL_LIVE
+        raise ValueError('Unknown api mode: %r' % (mode, ))
+
+    def _make_session(self, base_url):
+        # Idempotent requests (GET) are retried on connection errors and on
+        # throttling/5xx responses; Retry-After headers are respected
+        retry = Retry(
+            total=self.max_retries,
+            backoff_factor=self.backoff,
+            status_forcelist=self.retry_statuses,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount(base_url, adapter)
+        return session
+
+    def session(self, mode='settings'):
+        base_url = self.base_url(mode)
+        session = self._sessions.get(base_url)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(base_url)
+                if session is None:
+                    session = self._sessions[base_url] = self._make_session(base_url)
+        return session
+
+    def request(self, method, url, mode='settings', **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(mode).request(method, url, **kwargs)
+
+    @property
+    def stats(self):
+        '''
+        Returns a dict with the number of requests made through the pool,
+        connections opened and requests served by an already open connection
+        '''
+        requests_made = opened = 0
+        for session in list(self._sessions.values()):
+            for adapter in session.adapters.values():
+                poolmanager = getattr(adapter, 'poolmanager', None)
+                if poolmanager is None:
+                    continue
+                for key in list(poolmanager.pools.keys()):
+                    pool = poolmanager.pools.get(key)
+                    if pool is None:
+                        continue
+                    requests_made += pool.num_requests
+                    opened += pool.num_connections
+        return {
+            'requests': requests_made,
+            'opened': opened,
+            'reused': max(requests_made - opened, 0),
+        }
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+class PaypalTokenManager(object):
+    '''
+    Caches OAuth access tokens per (client_id, mode) until shortly before
+    they expire.
+
+    Only one thread per process fetches a missing or expiring token, the
+    others wait for it and reuse the result. If `cache_alias` is set, tokens
+    are also stored in that django cache, so all processes sharing the cache
+    reuse a single token; a lock taken with cache.add() makes sure only one
+    of them fetches it, the others poll the cache until it shows up.
+    '''
+    lock_poll_interval = 0.1
+
+    def __init__(self, refresh_margin=PAYPAL_SUBS_TOKEN_REFRESH_MARGIN,
+                 cache_alias=PAYPAL_SUBS_TOKEN_CACHE,
+                 default_ttl=PAYPAL_SUBS_TOKEN_DEFAULT_TTL,
+                 lock_timeout=PAYPAL_SUBS_TOKEN_LOCK_TIMEOUT):
+        self.refresh_margin = refresh_margin
+        self.cache_alias    = cache_alias
+        self.default_ttl    = default_ttl
+        self.lock_timeout   = lock_timeout
+        self._tokens = {}  # (client_id, mode) -> (access_token, refresh_at)
+        self._locks  = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(key):
+        client_id, mode = key
+        return 'djpp:paypal-token:%s:%s' % (client_id, 'live' if mode else 'sandbox')
+
+    @property
+    def cache(self):
+        if self.cache_alias:
+            return caches[self.cache_alias]
+
+    def _get_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _is_fresh(self, entry, stale_token=None):
+        if entry is None or (stale_token is not None and entry[0] == stale_token):
+            return False
+        return entry[1] > time.time()
+
+    def _make_entry(self, dic):
+        '''
+        Turns a /v1/oauth2/token response into an (access_token, refresh_at)
+        entry. A missing or unparsable expires_in falls back to default_ttl,
+        and the refresh margin never exceeds half the token lifetime, so a
+        short-lived token is still reused for a while instead of being
+        refetched on every call.
+        '''
+        try:
+            lifetime = int(dic.get('expires_in') or 0)
+        except (TypeError, ValueError):
+            lifetime = 0
+        if lifetime <= 0:
+            lifetime = self.default_ttl
+        margin = min(self.refresh_margin, lifetime // 2)
+        return (dic.get('access_token'), time.time() + lifetime - margin)
+
+    def _read_cache(self, key, stale_token=None):
+        entry = self.cache.get(self.cache_key(key))
+        if self._is_fresh(entry, stale_token):
+            self._tokens[key] = entry
+            return entry
+
+    def _fetch(self, key, fetch):
+        entry = self._make_entry(fetch() or {})
+        self._tokens[key] = entry
+        cache = self.cache
+        if cache is not None:
+            cache.set(self.cache_key(key), entry,
+                      timeout=max(int(entry[1] - time.time()), 1))
+        return entry
+
+    def get(self, key, fetch, stale_token=None):
+        '''
+        Returns a valid access token for `key`. `fetch` is called without
+        arguments when a new token is needed and should return the decoded
+        /v1/oauth2/token response. A token equal to `stale_token` (e.g. one
+        that was just rejected with 401) is never returned.
+        '''
+        entry = self._tokens.get(key)
+        if self._is_fresh(entry, stale_token):
+            return entry[0]
+
+        with self._get_lock(key):
+            # Another thread might have refreshed the token while we waited
+            entry = self._tokens.get(key)
+            if self._is_fresh(entry, stale_token):
+                return entry[0]
+
+            cache = self.cache
+            if cache is None:
+                return self._fetch(key, fetch)[0]
+
+            entry = self._read_cache(key, stale_token)
+            if entry is not None:
+                return entry[0]
+
+            # Only one process fetches; the others wait for its token. If the
+            # lock holder dies, its lock expires and someone else takes over.
+            lock_key = self.cache_key(key) + ':lock'
+            deadline = time.time() + self.lock_timeout
+            while not cache.add(lock_key, True, timeout=self.lock_timeout):
+                if time.time() >= deadline:
+                    # Give up waiting and fetch without the lock
+                    return self._fetch(key, fetch)[0]
+                time.sleep(self.lock_poll_interval)
+                entry = self._read_cache(key, stale_token)
+                if entry is not None:
+                    return entry[0]
+
+            try:
+                # The token may have been stored between our read and add()
+                entry = self._read_cache(key, stale_token)
+                if entry is None:
+                    entry = self._fetch(key, fetch)
+                return entry[0]
+            finally:
+                cache.delete(lock_key)
+
+    def invalidate(self, key, token=None):
+        '''
+        Forgets the token for `key`; if `token` is given, only forgets it if
+        it's still the current one (so concurrent 401s cause a single refresh)
+        '''
+        with self._get_lock(key):
+            entry = self._tokens.get(key)
+            if entry is None or (token is not None and entry[0] != token):
+                return
+            del self._tokens[key]
+            cache = self.cache
+            if cache is not None:
+                cache.delete(self.cache_key(key))
+
+
 class PaypalApi(object):
     client_id = PAYPAL_SUBS_CLIENT_ID
     secret    = PAYPAL_SUBS_SECRET
-    _token    = None
+
+    pool   = PaypalSessionPool()
+    tokens = PaypalTokenManager()
 
     @classproperty
     def token(cls):
-        if cls._token:
-            return cls._token
-        else:
-            cls._token = cls.get_api_token()
-            return cls._token
+        return cls.get_token()
 
     @classmethod
-    def build_endpoint(cls, endpoint, endpoint_id=None, mode='settings'):
-        if mode == 'settings':
-            url = PAYPAL_SUBS_API_BASE_URL + endpoint
-        elif mode == APIMODE_SANDBOX:
-            url = PAYPAL_SUBS_API_BASE_URL_SANDBOX + endpoint
-        elif mode == APIMODE_LIVE:
-            url = PAYPAL_SUBS_API_BASE_URL_LIVE + endpoint
+    def get_token(cls, mode='settings', stale_token=None):
+        mode = resolve_mode(mode)
+        return cls.tokens.get(
+            (cls.client_id, mode),
+            lambda: cls.request_api_token(mode=mode),
+            stale_token=stale_token,
+        )
 
+    @classmethod
+    def build_endpoint(cls, endpoint, endpoint_id=None, mode='settings'):
+        url = cls.pool.base_url(mode) + endpoint
         if endpoint_id:
             url += '/%s' % endpoint_id
         return url
 
     @classmethod
     def get_api_token(cls, client_id=None, secret=None, mode='settings', **kwargs):
+        dic = cls.request_api_token(client_id, secret, mode=mode, **kwargs)
+        return dic.get('access_token')
+
+    @classmethod
+    def request_api_token(cls, client_id=None, secret=None, mode='settings', **kwargs):
+        '''Returns the full token response, including expires_in'''
         endpoint = '/v1/oauth2/token'
         url = cls.build_endpoint(endpoint, mode=mode)
         headers = {
@@ -49,42 +304,95 @@ class PaypalApi(object):
         client_id = client_id or cls.client_id
         secret    = secret or cls.secret
 
-        r = requests.post(url, headers=headers, data=data, auth=(client_id, secret))
+        r = cls.pool.request('POST', url, mode=mode, headers=headers, data=data,
+                             auth=(client_id, secret))
         r.raise_for_status()
-        dic = r.json() or {}
-        return dic.get('access_token')
+        return r.json() or {}
+
+    @classmethod
+    def request(cls, method, url, mode='settings', headers=None, **kwargs):
+        '''
+        Makes an authorized request; if PayPal rejects the token with 401,
+        fetches a new one and retries once
+        '''
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        token = cls.get_token(mode=mode)
+        headers['Authorization'] = 'Bearer %s' % token
+        r = cls.pool.request(method, url, mode=mode, headers=headers, **kwargs)
+        if r.status_code == 401:
+            token = cls.get_token(mode=mode, stale_token=token)
+            headers['Authorization'] = 'Bearer %s' % token
+            r = cls.pool.request(method, url, mode=mode, headers=headers, **kwargs)
+        r.raise_for_status()
+        return r
 
     @classmethod
-    def list(cls, endpoint, mode='settings', **kwargs):
+    def list(cls, endpoint, mode='settings', page_size=None, **kwargs):
+        return list(cls.iter_pages(endpoint, mode=mode, page_size=page_size))
+
+    @classmethod
+    def _page_url(cls, url, page, page_size=None):
+        url = f'{url}?page={page}&total_required=true'
+        if page_size:
+            url += f'&page_size={page_size}'
+        return url
+
+    @classmethod
+    def _next_page_url(cls, dic, url, page, page_size=None):
+        for link in dic.get('links', []):
+            if link.get('rel') == 'next' and link.get('href'):
+                return link['href']
+        if page < dic.get('total_pages', 1):
+            return cls._page_url(url, page + 1, page_size)
+        return None
+
+    @classmethod
+    def iter_pages(cls, endpoint, mode='settings', page_size=None, prefetch=False, **kwargs):
+        '''
+        Lazily yields the pages of a list endpoint.
+
+        Follows the HATEOAS 'next' link when the page has one, otherwise
+        requests pages by number up to 'total_pages'. With prefetch=True,
+        the next page is requested in a background thread while the caller
+        is processing the current one.
+        '''
         url = cls.build_endpoint(endpoint, mode=mode)
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer %s' % cls.token,
-        }
 
-        page = 1
-        total_pages = 1
-        page_lists = []
-        while page <= total_pages:
-            r = requests.get(f'{url}?page={page}&total_required=true', headers=headers)
-            r.raise_for_status()
-            dic = r.json()
-            total_pages = dic.get('total_pages', 1)
-            page_lists.append(dic)
-            page += 1
-        return page_lists
+        def fetch(page_url):
+            return cls.request('GET', page_url, mode=mode).json()
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            page = 1
+            dic = fetch(cls._page_url(url, page, page_size))
+            while True:
+                next_url = cls._next_page_url(dic, url, page, page_size)
+                if next_url and executor:
+                    future = executor.submit(fetch, next_url)
+                yield dic
+                if not next_url:
+                    return
+                dic = future.result() if executor else fetch(next_url)
+                page += 1
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+
+    @classmethod
+    def iter_items(cls, endpoint, key, mode='settings', page_size=None, prefetch=False, **kwargs):
+        '''
+        Lazily yields the objects listed under `key` (e.g. 'products')
+        on every page of a list endpoint
+        '''
+        for dic in cls.iter_pages(endpoint, mode=mode, page_size=page_size, prefetch=prefetch):
+            yield from dic.get(key, [])
 
     @classmethod
     def get(cls, endpoint, endpoint_id=None, mode='settings', **kwargs):
         if not endpoint_id:
             raise ValueError('Specify endpoint_id to make get details request')
         url = cls.build_endpoint(endpoint, endpoint_id, mode=mode)
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer %s' % cls.token,
-        }
-        r = requests.get(url, headers=headers)
-        r.raise_for_status()
+        r = cls.request('GET', url, mode=mode)
         return r.json()
 
     @classmethod
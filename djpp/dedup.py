@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from .settings import PAYPAL_SUBS_WEBHOOK_DEDUP_CACHE, PAYPAL_SUBS_WEBHOOK_DEDUP_TTL
+
+
+class SeenSet(object):
+    '''
+    A short-lived set of recently handled webhook keys (transmission and
+    event ids), each mapped to the id of the trigger that handled it.
+
+    Keys are kept in a bounded in-memory LRU and, if `cache_alias` is set,
+    in that django cache so that other processes see them too. The number
+    of duplicates answered from the set is counted in `suppressed`.
+    '''
+    prefix = 'djpp:webhook-seen:'
+
+    def __init__(self, ttl=PAYPAL_SUBS_WEBHOOK_DEDUP_TTL,
+                 cache_alias=PAYPAL_SUBS_WEBHOOK_DEDUP_CACHE, max_size=10000):
+        self.ttl = ttl
+        self.cache_alias = cache_alias
+        self.max_size = max_size
+        self.suppressed = 0
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        if self.cache_alias:
+            return caches[self.cache_alias]
+
+    def get(self, key):
+        if not key:
+            return None
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self._seen.move_to_end(key)
+                    return entry[0]
+                del self._seen[key]
+
+        cache = self.cache
+        if cache is not None:
+            value = cache.get(self.prefix + key)
+            if value is not None:
+                self._remember(key, value)
+            return value
+        return None
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._seen[key] = (value, time.time() + self.ttl)
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+
+    def add(self, key, value):
+        if not key:
+            return
+        self._remember(key, value)
+        cache = self.cache
+        if cache is not None:
+            cache.set(self.prefix + key, value, timeout=self.ttl)
+
+    def count_suppressed(self):
+        with self._lock:
+            self.suppressed += 1
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+            self.suppressed = 0
+
+
+seen_webhooks = SeenSet()
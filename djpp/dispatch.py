@@ -0,0 +1,212 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from functools import partial
+
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+
+from .settings import PAYPAL_SUBS_WEBHOOK_DEFERRED_BACKEND, PAYPAL_SUBS_WEBHOOK_DEFERRED_WORKERS
+
+
+class _Node(object):
+    __slots__ = ('children', 'wildcards', 'handlers', 'tail_handlers')
+
+    def __init__(self):
+        self.children = {}       # exact segment -> _Node
+        self.wildcards = {}      # segment pattern containing '*' -> _Node
+        self.handlers = []       # (order, handler) for patterns ending here
+        self.tail_handlers = []  # same, but also matching any further segments
+
+
+def _handler_name(handler):
+    return '%s.%s' % (handler.__module__, getattr(handler, '__qualname__', repr(handler)))
+
+
+class WebhookDispatcher(object):
+    '''
+    Routes webhook event types to the handlers registered for them.
+
+    Handler patterns are dotted event types like 'billing.subscription.*'.
+    Patterns are compiled into a trie keyed on their dotted segments; a
+    segment may contain '*' wildcards, which, as with fnmatch, also match
+    across dots (so 'billing.*' matches 'billing.subscription.created' and
+    '*.created' matches 'billing.plan.created').
+
+    The handlers of an event type are resolved once and cached until
+    another handler is registered. The time spent in every handler is
+    recorded, see latency().
+
+    Handlers registered as deferred are not called inline, but after the
+    current transaction commits, in a thread pool of `deferred_workers`
+    threads or through `deferred_backend`, a callable (or its dotted path)
+    receiving the handler and its keyword arguments. Exceptions that are
+    not raised to the caller (robust dispatch, deferred handlers) are
+    passed to `on_error(handler, exception, kwargs)`.
+    '''
+    def __init__(self, deferred_workers=PAYPAL_SUBS_WEBHOOK_DEFERRED_WORKERS,
+                 deferred_backend=PAYPAL_SUBS_WEBHOOK_DEFERRED_BACKEND, on_error=None):
+        self.deferred_workers = deferred_workers
+        self.deferred_backend = deferred_backend
+        self.on_error = on_error
+        self._root = _Node()
+        self._cache = {}
+        self._order = 0
+        self._deferred = set()
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats = {}  # handler name -> [calls, total seconds, max seconds]
+
+    def register(self, pattern, handler, deferred=False):
+        segments = pattern.lower().split('.')
+        with self._lock:
+            node = self._root
+            for segment in segments:
+                branch = node.wildcards if '*' in segment else node.children
+                node = branch.setdefault(segment, _Node())
+
+            handlers = node.tail_handlers if '*' in segments[-1] else node.handlers
+            if handler not in [h for order, h in handlers]:
+                self._order += 1
+                handlers.append((self._order, handler))
+            if deferred:
+                self._deferred.add(handler)
+            self._cache = {}
+
+    def _match(self, node, segments, i, found):
+        if i == len(segments):
+            found.extend(node.handlers)
+            return
+        child = node.children.get(segments[i])
+        if child is not None:
+            self._match(child, segments, i + 1, found)
+        for pattern, child in node.wildcards.items():
+            # The wildcard segment may stand for several event type segments
+            for j in range(i + 1, len(segments) + 1):
+                if fnmatchcase('.'.join(segments[i:j]), pattern):
+                    if j == len(segments):
+                        found.extend(child.tail_handlers)
+                    self._match(child, segments, j, found)
+
+    def resolve(self, event_type):
+        '''Returns the handlers of an event type, in registration order'''
+        event_type = event_type.lower()
+        handlers = self._cache.get(event_type)
+        if handlers is None:
+            found = []
+            self._match(self._root, event_type.split('.'), 0, found)
+            handlers = []
+            for order, handler in sorted(found, key=lambda item: item[0]):
+                if handler not in handlers:
+                    handlers.append(handler)
+            handlers = self._cache[event_type] = tuple(handlers)
+        return handlers
+
+    def _record(self, handler, elapsed):
+        name = _handler_name(handler)
+        with self._lock:
+            stats = self._stats.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def call(self, handler, **kwargs):
+        started = time.perf_counter()
+        try:
+            return handler(**kwargs)
+        finally:
+            self._record(handler, time.perf_counter() - started)
+
+    def dispatch(self, event_type, robust=False, **kwargs):
+        '''
+        Calls every handler of `event_type` with `kwargs`, like Signal.send,
+        or schedules it if it's deferred.
+
+        With robust=True, exceptions are caught and recorded (like
+        Signal.send_robust); otherwise the first one is raised.
+        Returns a list of outcomes, {'handler', 'status', 'time', 'error'},
+        where status is one of 'ok', 'error' or 'deferred'.
+        '''
+        outcomes = []
+        for handler in self.resolve(event_type):
+            outcome = {'handler': _handler_name(handler), 'status': 'ok', 'time': 0.0}
+            outcomes.append(outcome)
+            if handler in self._deferred:
+                outcome['status'] = 'deferred'
+                transaction.on_commit(partial(self._submit, handler, kwargs))
+                continue
+
+            started = time.perf_counter()
+            try:
+                self.call(handler, **kwargs)
+            except Exception as e:
+                if not robust:
+                    raise
+                outcome['status'] = 'error'
+                outcome['error'] = '%s: %s' % (e.__class__.__name__, e)
+                self._handle_error(handler, e, kwargs)
+            finally:
+                outcome['time'] = time.perf_counter() - started
+        return outcomes
+
+    def send(self, signal, sender, robust=False, **kwargs):
+        '''
+        Sends `signal` to the receivers connected to it directly, with
+        Signal.send_robust if robust=True (exceptions are then recorded and
+        passed to on_error, as in dispatch()) or else Signal.send.
+        Returns their outcomes like dispatch(); as the signal calls them,
+        their time is not measured and is None.
+        '''
+        send = signal.send_robust if robust else signal.send
+        outcomes = []
+        for receiver, response in send(sender=sender, **kwargs):
+            outcome = {'handler': _handler_name(receiver), 'status': 'ok', 'time': None}
+            outcomes.append(outcome)
+            if robust and isinstance(response, Exception):
+                outcome['status'] = 'error'
+                outcome['error'] = '%s: %s' % (response.__class__.__name__, response)
+                self._handle_error(receiver, response, dict(kwargs, sender=sender))
+        return outcomes
+
+    def _handle_error(self, handler, exception, kwargs):
+        if self.on_error is not None:
+            self.on_error(handler, exception, kwargs)
+
+    def _submit(self, handler, kwargs):
+        backend = self.deferred_backend
+        if backend:
+            if isinstance(backend, str):
+                backend = import_string(backend)
+            backend(handler, kwargs)
+            return
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.deferred_workers, thread_name_prefix='djpp-webhooks'
+                )
+        self._executor.submit(self._run_deferred, handler, kwargs)
+
+    def _run_deferred(self, handler, kwargs):
+        try:
+            self.call(handler, **kwargs)
+        except Exception as e:
+            self._handle_error(handler, e, kwargs)
+        finally:
+            # Don't leak the db connections of the worker thread
+            connections.close_all()
+
+    def latency(self):
+        '''Returns {handler name: {calls, total, avg, max}} with times in seconds'''
+        with self._lock:
+            return {
+                name: {
+                    'calls': calls, 'total': total, 'avg': total / calls, 'max': longest,
+                }
+                for name, (calls, total, longest) in self._stats.items()
+            }
+
+    def reset_latency(self):
+        with self._lock:
+            self._stats = {}
@@ -0,0 +1,31 @@
+'''
+Fast lookups of what users are currently entitled to through their
+billing agreements and subscriptions.
+
+Entitlements are read from the denormalized Entitlement table (and the
+PAYPAL_SUBS_ENTITLEMENT_CACHE, if set), which WebhookEvent.process keeps
+up to date. Run the djpp_rebuild_entitlements command to fill it.
+'''
+from .models import Entitlement
+
+
+def _user_id(user):
+    return getattr(user, 'pk', user)
+
+
+def get_entitlements(user):
+    '''Returns the active entitlements of user (a user or a user id)'''
+    return get_entitlements_bulk([user])[_user_id(user)]
+
+
+def get_entitlements_bulk(users):
+    '''Returns {user id: [active entitlements]} for many users at once'''
+    return Entitlement.objects.for_users(_user_id(user) for user in users)
+
+
+def has_active_plan(user, plan_id=None):
+    '''Whether user is entitled to the plan plan_id, or to any plan if None'''
+    return any(
+        plan_id is None or entitlement.plan_id == plan_id
+        for entitlement in get_entitlements(user)
+    )
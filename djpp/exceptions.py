@@ -4,3 +4,7 @@ class PaypalApiError(Exception):
 
 class AgreementAlreadyExecuted(Exception):
     pass
+
+
+class WebhookCertificateError(Exception):
+    pass
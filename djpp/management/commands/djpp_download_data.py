@@ -1,13 +1,31 @@
 from django.core.management import BaseCommand
+from djpp.api import PaypalApi
 from djpp.models import Product, Plan
+from djpp.settings import PAYPAL_SUBS_SYNC_MAX_WORKERS
 
 
 class Command(BaseCommand):
     help = 'Syncs all data from upstream Paypal'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=PAYPAL_SUBS_SYNC_MAX_WORKERS,
+            help='Number of concurrent detail requests',
+        )
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='Only download and write objects updated since the last sync',
+        )
+
     def handle(self, *args, **kwargs):
+        options = dict(max_workers=kwargs['workers'], incremental=kwargs['incremental'])
+
         print('# Downloading products\n')
-        Product.init_from_api()
+        Product.init_from_api(**options)
 
         print('# Downloading plans\n')
-        Plan.init_from_api()
+        Plan.init_from_api(**options)
+
+        stats = PaypalApi.pool.stats
+        print('\n# HTTP connections: {opened} opened, {reused} reused '
+              '({requests} requests)'.format(**stats))
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management import BaseCommand
+from djpp.models import WebhookEventTrigger
+
+
+class Command(BaseCommand):
+    help = 'Verifies and processes queued webhook triggers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit once there are no more due triggers instead of polling',
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=1.0,
+            help='Seconds to wait before polling again when the queue is empty',
+        )
+
+    def handle(self, *args, **kwargs):
+        while True:
+            trigger = WebhookEventTrigger.process_queued()
+            if trigger is None:
+                if kwargs['once']:
+                    return
+                time.sleep(kwargs['sleep'])
+                continue
+
+            if trigger.exception:
+                status = 'failed (attempt %d): %s' % (trigger.attempts, trigger.exception)
+            elif not trigger.valid:
+                status = 'invalid'
+            else:
+                status = 'processed'
+            print(f'Trigger {trigger.pk} {status}')
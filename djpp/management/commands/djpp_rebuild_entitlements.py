@@ -0,0 +1,10 @@
+from django.core.management import BaseCommand
+from djpp.models import Entitlement
+
+
+class Command(BaseCommand):
+    help = 'Recreates the entitlements of all billing agreements and subscriptions'
+
+    def handle(self, *args, **kwargs):
+        count = Entitlement.objects.rebuild()
+        print(f'# Rebuilt {count} entitlements')
@@ -0,0 +1,21 @@
+import time
+
+from django.core.management import BaseCommand
+from djpp.models import BillingAgreement
+from djpp.settings import PAYPAL_SUBS_SYNC_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Recalculates end_of_period of all billing agreements'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=PAYPAL_SUBS_SYNC_BATCH_SIZE,
+            help='Number of agreements read and written at once',
+        )
+
+    def handle(self, *args, **kwargs):
+        started = time.time()
+        changed = BillingAgreement.recompute_end_of_period(batch_size=kwargs['batch_size'])
+        print(f'# Updated end_of_period of {changed} agreements '
+              f'in {time.time() - started:.2f}s')
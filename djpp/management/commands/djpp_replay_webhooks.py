@@ -0,0 +1,151 @@
+import queue
+import threading
+import time
+from fnmatch import fnmatch
+from zlib import crc32
+
+from dateutil.parser import parse
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from djpp.models import WebhookEventTrigger
+from djpp.settings import PAYPAL_SUBS_WEBHOOK_ID
+
+
+def parse_aware(value):
+    '''Parses a --since/--until value, assuming the current timezone if naive'''
+    dt = parse(value)
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt)
+    return dt
+
+
+class Command(BaseCommand):
+    help = (
+        'Reprocesses stored webhook triggers. Triggers of the same resource are '
+        'always handled by the same worker, in the order the events were created.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=parse_aware, help='Only triggers received at or after')
+        parser.add_argument('--until', type=parse_aware, help='Only triggers received before')
+        parser.add_argument(
+            '--event-type', action='append', default=[], dest='event_types',
+            help='Only these event types (wildcards allowed, can be repeated)',
+        )
+        parser.add_argument('--valid', action='store_true', default=None)
+        parser.add_argument('--invalid', action='store_false', dest='valid')
+        parser.add_argument('--processed', action='store_true', default=None)
+        parser.add_argument('--unprocessed', action='store_false', dest='processed')
+        parser.add_argument('--failed', action='store_true', help='Only triggers with an exception')
+        parser.add_argument(
+            '--reverify', action='store_true',
+            help='Verify the signature again instead of trusting the stored result',
+        )
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def get_queryset(self, options):
+        # Order by the event's create_time; triggers that never got as far as
+        # storing their WebhookEvent (or whose body can't be parsed) fall back
+        # to the time they were received.
+        queryset = WebhookEventTrigger.objects.annotate(
+            event_time=Coalesce('webhook_event__create_time', 'created'),
+        ).order_by('event_time', 'created', 'id')
+        if options['since']:
+            queryset = queryset.filter(created__gte=options['since'])
+        if options['until']:
+            queryset = queryset.filter(created__lt=options['until'])
+        if options['valid'] is not None:
+            queryset = queryset.filter(valid=options['valid'])
+        if options['processed'] is not None:
+            queryset = queryset.filter(processed=options['processed'])
+        if options['failed']:
+            queryset = queryset.exclude(exception='')
+        return queryset
+
+    def handle(self, *args, **options):
+        event_types = [event_type.lower() for event_type in options['event_types']]
+        workers = max(options['workers'], 1)
+        reverify = options['reverify']
+
+        queues = [queue.Queue(maxsize=options['chunk_size']) for i in range(workers)]
+        lock = threading.Lock()
+        stats = {'processed': 0, 'invalid': 0, 'failed': 0}
+        failures = []
+
+        def process(trigger):
+            if not reverify and not trigger.valid:
+                return 'invalid'
+            trigger.exception = ''
+            trigger.verify_and_process(PAYPAL_SUBS_WEBHOOK_ID, verify=reverify)
+            if trigger.exception:
+                return 'failed'
+            elif not trigger.valid:
+                return 'invalid'
+            return 'processed'
+
+        def work(q):
+            # Never let an exception end the thread: the main thread would
+            # block forever on put() once this worker's queue is full.
+            try:
+                while True:
+                    trigger = q.get()
+                    if trigger is None:
+                        return
+                    try:
+                        result = process(trigger)
+                    except Exception as e:
+                        result = 'failed'
+                        trigger.exception = str(e)[:128] or type(e).__name__
+                    with lock:
+                        stats[result] += 1
+                        if result == 'failed':
+                            failures.append((trigger.pk, trigger.exception))
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=work, args=(q, )) for q in queues]
+        for thread in threads:
+            thread.start()
+
+        def put(i, item):
+            while True:
+                try:
+                    return queues[i].put(item, timeout=1)
+                except queue.Full:
+                    if not threads[i].is_alive():
+                        raise CommandError(f'Replay worker {i} died')
+
+        started = time.time()
+        total = 0
+        try:
+            queryset = self.get_queryset(options)
+            for trigger in queryset.iterator(chunk_size=options['chunk_size']):
+                data = trigger.data
+                event_type = str(data.get('event_type', '')).lower()
+                if event_types and not any(fnmatch(event_type, t) for t in event_types):
+                    continue
+
+                # Pin every resource to one worker to keep its events in order
+                resource = data.get('resource') or {}
+                key = str(resource.get('id') or trigger.pk)
+                put(crc32(key.encode()) % workers, trigger)
+                total += 1
+        finally:
+            for i in range(workers):
+                try:
+                    put(i, None)
+                except CommandError:
+                    pass
+            for thread in threads:
+                thread.join()
+
+        elapsed = time.time() - started
+        print(f'# Replayed {total} triggers in {elapsed:.2f}s '
+              f'({total / elapsed if elapsed else 0:.1f}/s): '
+              f'{stats["processed"]} processed, {stats["invalid"]} invalid, '
+              f'{stats["failed"]} failed')
+        for pk, exception in failures:
+            print(f'Trigger {pk} failed: {exception}')
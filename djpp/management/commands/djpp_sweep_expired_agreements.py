@@ -0,0 +1,20 @@
+from dateutil.parser import parse
+from django.core.management import BaseCommand
+from djpp.models import BillingAgreement
+
+
+class Command(BaseCommand):
+    help = (
+        'Sends billing_agreements_expired for the agreements whose '
+        'end_of_period passed since the previous sweep'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since', type=parse,
+            help='Sweep from this ISO 8601 date instead of the previous sweep',
+        )
+
+    def handle(self, *args, **kwargs):
+        count = BillingAgreement.sweep_expired(since=kwargs['since'])
+        print(f'# {count} agreements expired')
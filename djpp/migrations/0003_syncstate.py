@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpp', '0002_checkoutorder_payer_model'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=64)),
+                ('livemode', models.BooleanField()),
+                ('watermark', models.DateTimeField(blank=True, help_text='The newest update_time of all objects synced so far', null=True)),
+                ('last_synced', models.DateTimeField(blank=True, null=True)),
+                ('last_synced_count', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('model', 'livemode')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpp', '0003_syncstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookeventtrigger',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='webhookeventtrigger',
+            name='next_attempt',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='webhookeventtrigger',
+            name='queued',
+            field=models.BooleanField(db_index=True, default=False, help_text='Waiting to be verified and processed by a background worker.'),
+        ),
+    ]
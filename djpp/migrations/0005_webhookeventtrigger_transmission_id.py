@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:03
+
+from django.db import migrations, models
+
+
+# Existing triggers may contain redeliveries of the same transmission, so
+# only the first trigger of every transmission gets the id
+BACKFILL_TRANSMISSION_ID = '''
+UPDATE djpp_webhookeventtrigger
+SET transmission_id = headers->>'paypal-transmission-id'
+WHERE id IN (
+    SELECT MIN(id) FROM djpp_webhookeventtrigger
+    WHERE headers ? 'paypal-transmission-id'
+    GROUP BY headers->>'paypal-transmission-id'
+)
+'''
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpp', '0004_webhookeventtrigger_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookeventtrigger',
+            name='transmission_id',
+            field=models.CharField(blank=True, editable=False, help_text='The paypal-transmission-id header, used to detect redeliveries.', max_length=128, null=True),
+        ),
+        migrations.RunSQL(BACKFILL_TRANSMISSION_ID, migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='webhookeventtrigger',
+            name='transmission_id',
+            field=models.CharField(blank=True, editable=False, help_text='The paypal-transmission-id header, used to detect redeliveries.', max_length=128, null=True, unique=True),
+        ),
+    ]
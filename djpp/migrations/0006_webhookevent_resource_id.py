@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:04
+
+from django.db import migrations, models
+
+
+BACKFILL_RESOURCE_ID = '''
+UPDATE djpp_webhookevent
+SET resource_id = COALESCE(resource->>'id', resource->>'dispute_id', '')
+'''
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpp', '0005_webhookeventtrigger_transmission_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookevent',
+            name='resource_id',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=128),
+        ),
+        migrations.RunSQL(BACKFILL_RESOURCE_ID, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:06
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpp', '0006_webhookevent_resource_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookeventtrigger',
+            name='handler_outcomes',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=list, help_text='Outcome of every webhook handler run for the event.'),
+        ),
+    ]
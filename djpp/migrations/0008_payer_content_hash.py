@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpp', '0007_webhookeventtrigger_handler_outcomes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payer',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=40),
+        ),
+    ]
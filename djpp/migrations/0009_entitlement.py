@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:14
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('djpp', '0008_payer_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Entitlement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(choices=[('agreement', 'Billing agreement'), ('subscription', 'Subscription')], max_length=12)),
+                ('source_id', models.CharField(max_length=128)),
+                ('plan_id', models.CharField(blank=True, max_length=128)),
+                ('livemode', models.BooleanField()),
+                ('is_active', models.BooleanField()),
+                ('active_until', models.DateTimeField(blank=True, help_text='Empty if active until further notice', null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='paypal_entitlements', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('source', 'source_id')},
+                'index_together': {('user', 'is_active')},
+            },
+        ),
+    ]
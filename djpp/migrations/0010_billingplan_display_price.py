@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpp', '0009_entitlement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billingplan',
+            name='display_price',
+            field=models.CharField(blank=True, editable=False, max_length=128),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpp', '0010_billingplan_display_price'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='entitlement',
+            name='livemode',
+            field=models.BooleanField(blank=True, default=None, null=True),
+        ),
+    ]
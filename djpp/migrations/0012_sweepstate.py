@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-18 11:28
+
+from django.db import migrations, models
+
+
+def move_sweep_watermarks(apps, schema_editor):
+    # BillingAgreement.sweep_expired used to keep its watermark in SyncState
+    SyncState = apps.get_model('djpp', 'SyncState')
+    SweepState = apps.get_model('djpp', 'SweepState')
+    states = SyncState.objects.filter(model__endswith='.expired')
+    for state in states:
+        SweepState.objects.create(
+            name=state.model, livemode=state.livemode, watermark=state.watermark,
+            last_swept=state.last_synced, last_swept_count=state.last_synced_count,
+        )
+    states.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djpp', '0011_entitlement_livemode_null'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SweepState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('livemode', models.BooleanField()),
+                ('watermark', models.DateTimeField(blank=True, help_text='The end of the period covered by the previous sweep', null=True)),
+                ('last_swept', models.DateTimeField(blank=True, null=True)),
+                ('last_swept_count', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('name', 'livemode')},
+            },
+        ),
+        migrations.RunPython(move_sweep_watermarks, migrations.RunPython.noop),
+    ]
@@ -1,18 +1,21 @@
 from .billing import (BillingAgreement, BillingPlan, ChargeModel,
                       PaymentDefinition, PreparedBillingAgreement)
 from .disputes import Dispute
+from .entitlements import Entitlement
 from .payer import Payer
 from .orders import CheckoutOrder, Capture
 from .payments import Payment, Refund, Sale
 from .subscriptions import Product, Plan, Subscription
+from .sync import SweepState, SyncState
 from .webhooks import WebhookEvent, WebhookEventTrigger
 
 __all__ = [
     'BillingAgreement', 'BillingPlan', 'ChargeModel',
     'PaymentDefinition', 'PreparedBillingAgreement',
-    'Dispute', 'Payer',
+    'Dispute', 'Entitlement', 'Payer',
     'CheckoutOrder', 'Capture',
     'Payment', 'Refund', 'Sale',
     'Product', 'Plan', 'Subscription',
+    'SweepState', 'SyncState',
     'WebhookEvent', 'WebhookEventTrigger'
 ]
@@ -1,10 +1,98 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 from django.contrib.postgres.fields import JSONField
-from django.db import models
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import models, transaction
+from django.db.models.signals import class_prepared
+from django.dispatch import Signal
 from django.urls import reverse
 from django.utils.decorators import classproperty
+from django.utils.timezone import now
+
+from ..api import PaypalApi, resolve_mode
+from ..cleaners import compile_cleaner, parse_datetime
+from ..remote_cache import remote_objects
+from ..resolver import dependency_resolver
+from ..settings import (
+    PAYPAL_SUBS_LIVEMODE, PAYPAL_SUBS_SYNC_MAX_WORKERS, PAYPAL_SUBS_SYNC_BATCH_SIZE,
+)
+from .sync import SyncState
 
-from ..api import PaypalApi
-from ..settings import PAYPAL_SUBS_LIVEMODE
+# Sent when sync_data() changed and saved an existing object;
+# diff is a dict of {field: (old value, new value)}
+paypal_object_synced = Signal(providing_args=["instance", "diff"])
+
+
+class PaypalModelManager(models.Manager):
+    def sync_data(self, payloads, fetch=False):
+        '''
+        Upserts API objects given in full (e.g. the payment definitions of a
+        plan, or their charge models) in one batch, along with the children
+        in their `nested_m2ms`, in a constant number of queries.
+        With fetch=True, the objects are fetched from the API by id first.
+        Returns the list of their ids, in order.
+        '''
+        model = self.model
+        if fetch:
+            payloads = [model.fetch_paypal_object(payload['id']) for payload in payloads]
+
+        rows, children = [], {name: [] for name in model.nested_m2ms}
+        for payload in payloads:
+            pk, cleaned_data, m2ms = model.api_cleaner(payload)
+            for name in model.nested_m2ms:
+                children[name].append((pk, cleaned_data.pop(name, None) or []))
+            rows.append((pk, cleaned_data))
+
+        # Parents, objects and children are written in one transaction
+        with transaction.atomic():
+            if model.dependencies:
+                dependency_resolver.ensure(model, [data for pk, data in rows])
+            model.bulk_upsert(
+                [(pk, model.make_dict_with_defined_fields(data)) for pk, data in rows], finish=False
+            )
+
+            for name, parents in children.items():
+                related_model = model._meta.get_field(name).related_model
+                child_pks = iter(related_model.objects.sync_data(
+                    [child for pk, objs in parents for child in objs]
+                ))
+                self.set_m2m(name, {pk: [next(child_pks) for child in objs] for pk, objs in parents})
+
+        # Only now that the m2ms are set too
+        model.finish_bulk_upsert([pk for pk, data in rows])
+        return [pk for pk, data in rows]
+
+    def set_m2m(self, name, relations):
+        '''
+        Makes the many-to-many field `name` of each object in relations,
+        a dict of {pk: [related pks]}, hold exactly the given related
+        objects, with one SELECT, one bulk INSERT and one DELETE of the
+        through table.
+        '''
+        if not relations:
+            return
+        field = self.model._meta.get_field(name)
+        through = field.remote_field.through
+        source = through._meta.get_field(field.m2m_field_name()).attname
+        target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+
+        wanted = {(pk, related_pk) for pk, related_pks in relations.items() for related_pk in related_pks}
+        existing = {
+            (pk, related_pk): through_pk for through_pk, pk, related_pk in
+            through.objects.filter(**{source + '__in': list(relations)})
+            .values_list('pk', source, target)
+        }
+
+        with transaction.atomic():
+            stale = [through_pk for key, through_pk in existing.items() if key not in wanted]
+            if stale:
+                through.objects.filter(pk__in=stale).delete()
+            through.objects.bulk_create([
+                through(**{source: pk, target: related_pk})
+                for pk, related_pk in wanted if (pk, related_pk) not in existing
+            ])
 
 
 class PaypalModel(models.Model):
@@ -48,38 +136,207 @@ class PaypalModel(models.Model):
             return self.name
         return self.id
 
+    # Frozen set of field_names, computed once when the model class is prepared
+    _field_name_set = frozenset()
+
+    # {field name: djpp.cleaners.ApiField} describing how fields are read from
+    # API payloads; DateTimeFields are parsed automatically
+    api_fields = None
+
+    # Names of foreign keys to objects that must be in the db before this one
+    # is written; they are fetched by djpp.resolver.dependency_resolver
+    dependencies = ()
+
+    # Names of many-to-many fields whose related objects are nested in full
+    # in API payloads; they are synced along with this object
+    nested_m2ms = ()
+
+    objects = PaypalModelManager()
+
     @classproperty
     def field_names(cls):
         '''
         Returns list of field names, including some explicitly defined deferred
         attrs like product_id or plan_id
         '''
+        return list(cls._field_name_set)
+
+    @classmethod
+    def _prepare_field_names(cls):
+        '''
+        Collects the names values from the API can be assigned to: forward
+        fields and deferred_attrs. Foreign key attnames (e.g. product_id) are
+        only included when listed in deferred_attrs, so that ids of objects
+        we don't store (e.g. a sale's billing_agreement_id) end up in
+        _extra_fields instead of a foreign key.
+        '''
         if not isinstance(cls.deferred_attrs, list):
             cls.deferred_attrs = []
-        return [field.name for field in cls._meta.get_fields()] + cls.deferred_attrs
+        names = set(cls.deferred_attrs)
+        for field in cls._meta.fields + cls._meta.many_to_many:
+            names.add(field.name)
+        cls._field_name_set = frozenset(names)
 
     @classmethod
-    def init_from_api(cls, mode='settings', detailed=True, **kwargs):
-        page_lists = PaypalApi.list(cls.endpoint, mode=mode)
-        # obj_json = PaypalApi.list(cls.endpoint, mode=mode)
+    def init_from_api(cls, mode='settings', detailed=True,
+                      max_workers=PAYPAL_SUBS_SYNC_MAX_WORKERS,
+                      batch_size=PAYPAL_SUBS_SYNC_BATCH_SIZE, page_size=None,
+                      incremental=False, **kwargs):
+        '''
+        Downloads all objects from the API and stores them in the db.
+
+        With detailed=True, object details are fetched by up to `max_workers`
+        threads at once, while the results are still written to the db
+        in the order they were listed. Rate limiting (HTTP 429) responses are
+        retried by PaypalApi.pool with respect to the Retry-After header.
+
+        Rows are written with bulk_upsert() in batches of `batch_size`.
+        Pages are streamed, and the next page is already being downloaded
+        while the current one is processed.
+
+        With incremental=True, objects whose update_time is not newer than
+        the one already stored are neither fetched in detail nor written.
+        The newest update_time seen is recorded in SyncState.
+        '''
+        livemode = resolve_mode(mode)
+        page_lists = PaypalApi.iter_pages(
+            cls.endpoint, mode=mode, page_size=page_size, prefetch=True
+        )
         plural = cls.__name__.lower() + 's'
 
-        for page_list in page_lists:
-            obj_list = page_list.get(plural, [])
+        started = time.time()
+        count = skipped = 0
+        watermark = None
+        rows = []
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            for page_list in page_lists:
+                obj_list = page_list.get(plural, [])
+
+                known = {}
+                if incremental:
+                    known = dict(
+                        cls.objects.filter(pk__in=[obj['id'] for obj in obj_list])
+                        .values_list('pk', 'update_time')
+                    )
+                    changed = [obj for obj in obj_list if cls._is_newer(obj, known)]
+                    skipped += len(obj_list) - len(changed)
+                    obj_list = changed
 
-            for obj in obj_list:
-                pk = obj.pop('id')
                 if detailed:
                     # when you list_objects, not all the fields will be returned by API,
                     # so get the remaining fields one by one
-                    obj_details = PaypalApi.get(cls.endpoint, pk)
-                    obj_details.pop('id')
-                else:
-                    obj_details = obj
+                    fetch = partial(PaypalApi.get, cls.endpoint, mode=mode)
+                    obj_list = executor.map(fetch, [obj['id'] for obj in obj_list])
+
+                for obj_details in obj_list:
+                    # The list response may lack update_time, so check details again
+                    if incremental and not cls._is_newer(obj_details, known):
+                        skipped += 1
+                        continue
+
+                    pk, obj_details, m2ms = cls.api_cleaner(obj_details)
+                    print(f'pk: {pk}')
+                    obj_details['livemode'] = livemode
+                    update_time = obj_details.get('update_time')
+                    if update_time:
+                        watermark = max(watermark or update_time, update_time)
+
+                    rows.append((pk, cls.make_dict_with_defined_fields(obj_details)))
+                    count += 1
+
+                    if len(rows) >= batch_size:
+                        cls.bulk_upsert(rows, batch_size=batch_size)
+                        rows = []
+
+        cls.bulk_upsert(rows, batch_size=batch_size)
+        cls._save_sync_state(livemode, watermark, count)
+
+        elapsed = time.time() - started
+        print(f'# Synced {count} {plural} ({skipped} unchanged) in {elapsed:.2f}s '
+              f'({count / elapsed if elapsed else 0:.1f}/s)\n')
+        return count
+
+    @staticmethod
+    def _is_newer(obj, known):
+        '''
+        Whether the API object `obj` is newer than the stored version,
+        given `known`, a dict of stored update_times by pk
+        '''
+        stored = known.get(obj['id'])
+        if stored is None or not obj.get('update_time'):
+            return True
+        return parse_datetime(obj['update_time']) > stored
+
+    @classmethod
+    def _save_sync_state(cls, livemode, watermark, count):
+        state, created = SyncState.objects.get_or_create(
+            model=cls._meta.label_lower, livemode=livemode
+        )
+        if watermark and (state.watermark is None or watermark > state.watermark):
+            state.watermark = watermark
+        state.last_synced = now()
+        state.last_synced_count = count
+        state.save()
+        return state
+
+    @classmethod
+    def bulk_upsert(cls, rows, batch_size=PAYPAL_SUBS_SYNC_BATCH_SIZE, finish=True):
+        '''
+        Inserts or updates `rows`, an iterable of (pk, field dict) pairs.
+
+        Each batch of `batch_size` rows is written in its own transaction
+        with three queries: one SELECT of the existing rows, one bulk INSERT
+        of the new ones and one bulk UPDATE of the rest. Then, unless
+        finish=False, finish_bulk_upsert() is called with all their pks.
+        '''
+        # Later rows win if the same pk shows up more than once
+        rows = list(dict(rows).items())
+        for start in range(0, len(rows), batch_size):
+            cls._bulk_upsert_batch(rows[start:start + batch_size])
+        if finish and rows:
+            cls.finish_bulk_upsert([pk for pk, data in rows])
+
+    @classmethod
+    def _bulk_upsert_batch(cls, rows):
+        timestamp = now()
+        to_create, to_update, update_fields = [], [], {'updated'}
+
+        with transaction.atomic():
+            existing = cls.objects.in_bulk([pk for pk, data in rows])
+            for pk, data in rows:
+                obj = existing.get(pk)
+                if obj is None:
+                    to_create.append(cls(pk=pk, **data))
+                    continue
+                for k, v in data.items():
+                    setattr(obj, k, v)
+                    update_fields.add(cls._meta.get_field(k).name)
+                obj.updated = timestamp
+                to_update.append(obj)
+
+            # bulk_create/bulk_update skip save(), let the model make up for it
+            update_fields.update(cls.prepare_bulk_objects(to_create + to_update))
+            if to_create:
+                cls.objects.bulk_create(to_create)
+            if to_update:
+                cls.objects.bulk_update(to_update, update_fields)
 
-                print(f'pk: {pk}')
-                obj_details = cls.make_dict_with_defined_fields(obj_details)
-                cls.objects.update_or_create(pk=pk, **obj_details)
+    @classmethod
+    def prepare_bulk_objects(cls, objs):
+        '''
+        Called by bulk_upsert with the instances it is about to write, in
+        place of their save(). Returns the names of the fields it changed.
+        '''
+        return ()
+
+    @classmethod
+    def finish_bulk_upsert(cls, pks):
+        '''
+        Called with the pks of the objects written by bulk_upsert, or by
+        PaypalModelManager.sync_data once their nested m2ms are set too,
+        to update whatever is derived from them (e.g. display prices).
+        '''
+        pass
 
     @classmethod
     def make_dict_with_defined_fields(cls, obj_details):
@@ -90,19 +347,9 @@ class PaypalModel(models.Model):
         to pop non-existing fields from obj_details and insert them into
         a separate JSONField.
         '''
-        _extra_fields = {}
-        field_names = cls.field_names
-
-        # items = list(obj_details.items())
-        # for item in items:
-        #     print(item)
-        # print()
-
-        for k, v in list(obj_details.items()):
-            if k not in field_names:
-                _extra_fields[k] = v
-                obj_details.pop(k)
-        obj_details['_extra_fields'] = _extra_fields
+        # A single set difference instead of a lookup per key
+        extra_keys = obj_details.keys() - cls._field_name_set
+        obj_details['_extra_fields'] = {k: obj_details.pop(k) for k in extra_keys}
         return obj_details
 
     @staticmethod
@@ -114,20 +361,22 @@ class PaypalModel(models.Model):
 
     @classmethod
     def clean_api_data(cls, data):
-        cleaned_data = cls.sdk_object_as_dict(data)
-
-        # Delete links (only useful in the API itself)
-        # if "links" in cleaned_data:
-        #     del cleaned_data["links"]
-
-        # Extract the ID to return it separately
-        id = cleaned_data.pop(cls.id_field_name)
-        livemode = cls.extract_livemode(cleaned_data)
-
-        # Set the livemode; if failed to extract it from data,
-        # set the value from settings
-        cleaned_data["livemode"] = livemode or PAYPAL_SUBS_LIVEMODE
-        return id, cleaned_data, {}
+        '''
+        Converts an API payload into (id, cleaned_data, m2ms) with the
+        model's compiled api_cleaner (see djpp.cleaners). Subclasses
+        override this for conversions that need the db.
+        '''
+        id, cleaned_data, m2ms = cls.api_cleaner(data)
+        if cls.dependencies:
+            # Make sure the referenced objects exist and are fresh
+            dependency_resolver.ensure(cls, [cleaned_data])
+
+        for name in cls.nested_m2ms:
+            if name in cleaned_data:
+                related_model = cls._meta.get_field(name).related_model
+                # Sync the related objects but do not fetch them (we have them in full)
+                m2ms[name] = related_model.objects.sync_data(cleaned_data.pop(name))
+        return id, cleaned_data, m2ms
 
     @classmethod
     def extract_livemode(cls, data):
@@ -151,18 +400,33 @@ class PaypalModel(models.Model):
             cls.id_field_name: id,
             "defaults": cleaned_data,
         })
-        if always_sync or not created:
-            db_obj.sync_data(cleaned_data)
-            db_obj.save()
+        # A freshly created object already holds cleaned_data, so syncing
+        # it again (always_sync) would be a no-op
+        db_obj.sync_diff = {} if created else db_obj.sync_data(cleaned_data)
 
-        for field, objs in m2ms.items():
-            for obj in objs:
-                getattr(db_obj, field).add(obj)
+        for field, pks in m2ms.items():
+            cls.objects.set_m2m(field, {db_obj.pk: pks})
         return db_obj, created
 
+    @classmethod
+    def fetch_paypal_object(cls, id, livemode=None, fresh=False):
+        '''
+        Returns the API object with the given id, read through
+        djpp.remote_cache.remote_objects. Pass fresh=True to always fetch it
+        from the API, e.g. before changing its state.
+        '''
+        if livemode is None:
+            livemode = PAYPAL_SUBS_LIVEMODE
+        return remote_objects.get(cls, id, livemode, cls.paypal_model.find, fresh=fresh)
+
+    @classmethod
+    def forget_paypal_object(cls, id):
+        '''Drops the cached API object, e.g. after changing it'''
+        remote_objects.invalidate(cls, id)
+
     @classmethod
     def find_and_sync(cls, id):
-        obj = cls.paypal_model.find(id)
+        obj = cls.fetch_paypal_object(id)
         db_obj, created = cls.get_or_update_from_api_data(obj, always_sync=True)
         return db_obj
 
@@ -190,20 +454,42 @@ class PaypalModel(models.Model):
     def _sync_data_field(self, k, v):
         if k == "links":
             return False
+        try:
+            # Compare like with like, e.g. datetimes instead of ISO strings
+            v = self._meta.get_field(k).to_python(v)
+        except (FieldDoesNotExist, ValidationError):
+            pass
         if getattr(self, k) != v:
             setattr(self, k, v)
             return True
         return False
 
-    def find_paypal_object(self):
-        return self.paypal_model.find(self.id)
+    def find_paypal_object(self, fresh=False):
+        return self.fetch_paypal_object(self.id, self.livemode, fresh=fresh)
 
-    def sync_data(self, obj):
+    def sync_data(self, obj, save=True):
+        '''
+        Copies the values of `obj` onto this instance and, if any of them
+        changed, saves just the changed columns. Returns the diff, a dict of
+        {field: (old value, new value)}, empty if nothing changed.
+        '''
         obj = self.sdk_object_as_dict(obj)
-        updated = False
+        diff = {}
         for k, v in obj.items():
+            old = getattr(self, k, None)
             if self._sync_data_field(k, v):
-                updated = True
+                diff[k] = (old, getattr(self, k))
+
+        if diff and save:
+            self.save(update_fields=list(diff) + ["updated"])
+            paypal_object_synced.send(sender=self.__class__, instance=self, diff=diff)
+        return diff
+
+
+def prepare_paypal_model(sender, **kwargs):
+    if issubclass(sender, PaypalModel):
+        sender._prepare_field_names()
+        sender.api_cleaner = staticmethod(compile_cleaner(sender, PAYPAL_SUBS_LIVEMODE))
+
 
-        if updated:
-            self.save()
+class_prepared.connect(prepare_paypal_model)
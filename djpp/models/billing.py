@@ -1,20 +1,40 @@
 import re
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import lru_cache
 
-from dateutil.parser import parse
 from django.conf import settings
 from django.db import models, transaction
+from django.dispatch import Signal
 from django.utils.timezone import now
 from paypalrestsdk import payments as paypal_models
 
 from .. import enums
 from ..exceptions import AgreementAlreadyExecuted, PaypalApiError
 from ..fields import CurrencyAmountField, JSONField
-from ..settings import PAYPAL_SUBS_LIVEMODE
+from ..settings import PAYPAL_SUBS_LIVEMODE, PAYPAL_SUBS_SYNC_BATCH_SIZE
 from ..constants import APIMODE_CHOICES
-from .base import PaypalModel
+from ..cleaners import ApiField, parse_datetime
+from .base import PaypalModel, PaypalModelManager
+from .entitlements import Entitlement
+from .sync import SweepState
+from .webhooks import webhook_resource
 
+# Sent by BillingAgreement.sweep_expired with the queryset of the agreements
+# whose end_of_period passed since the previous sweep
+billing_agreements_expired = Signal(providing_args=["agreements", "livemode"])
 
+# end_of_period of agreements that were never paid
+NEVER_PAID_END_OF_PERIOD = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def normalize_agreement_state(state):
+    # Fix inconsistent US/UK spelling
+    if state.lower() == 'canceled':
+        return enums.BillingAgreementState.Cancelled
+    return state
+
+
+@lru_cache(maxsize=None)
 def get_frequency_delta(frequency, frequency_interval):
     from dateutil.relativedelta import relativedelta
 
@@ -28,6 +48,16 @@ def get_frequency_delta(frequency, frequency_interval):
     return relativedelta(**{frequency_kw: frequency_interval})
 
 
+class BillingPlanQuerySet(models.QuerySet):
+    def with_pricing(self):
+        '''
+        Prefetches the payment definitions, so that the pricing accessors
+        (regular_payment_definition, human_readable_price) don't query
+        '''
+        return self.prefetch_related('payment_definitions')
+
+
+@webhook_resource('plan', version='1.0')
 class BillingPlan(PaypalModel):
     name = models.CharField(max_length=128)
     description = models.CharField(max_length=127)
@@ -38,18 +68,42 @@ class BillingPlan(PaypalModel):
     merchant_preferences = JSONField()
 
     payment_definitions = models.ManyToManyField('PaymentDefinition')
+    # human_readable_price of the regular payment definition, refreshed on sync
+    display_price = models.CharField(max_length=128, blank=True, editable=False)
 
     paypal_model = paypal_models.BillingPlan
+    nested_m2ms = ('payment_definitions', )
+
+    objects = PaypalModelManager.from_queryset(BillingPlanQuerySet)()
 
     @classmethod
-    def clean_api_data(cls, data):
-        id, cleaned_data, m2ms = super().clean_api_data(data)
+    def get_or_update_from_api_data(cls, data, always_sync=False):
+        db_obj, created = super().get_or_update_from_api_data(data, always_sync=always_sync)
+        cls.refresh_display_prices(cls.objects.filter(pk=db_obj.pk))
+        return db_obj, created
 
-        pds = cleaned_data.pop('payment_definitions')
-        # Sync payment definitions but do not fetch them (we have them in full)
-        m2ms['payment_definitions'] = PaymentDefinition.objects.sync_data(pds, fetch=False)
+    @classmethod
+    def finish_bulk_upsert(cls, pks):
+        cls.refresh_display_prices(cls.objects.filter(pk__in=pks))
 
-        return id, cleaned_data, m2ms
+    @classmethod
+    def refresh_display_prices(cls, queryset=None):
+        '''
+        Recalculates display_price of the plans in `queryset` (all of them
+        by default), writing only the changed ones. Returns their number.
+        '''
+        if queryset is None:
+            queryset = cls.objects.all()
+
+        changed = []
+        for plan in queryset.with_pricing().only('id', 'display_price'):
+            display_price = plan.calculate_display_price()
+            if display_price != plan.display_price:
+                plan.display_price = display_price
+                changed.append(plan)
+        if changed:
+            cls.objects.bulk_update(changed, ['display_price'])
+        return len(changed)
 
     @classmethod
     def create(cls, data, activate=False):
@@ -66,22 +120,33 @@ class BillingPlan(PaypalModel):
 
     @property
     def regular_payment_definition(self):
-        return self.payment_definitions.get(type=enums.PaymentDefinitionType.REGULAR)
-
-    @property
-    def human_readable_price(self):
+        if 'payment_definitions' in getattr(self, '_prefetched_objects_cache', {}):
+            # Loaded by with_pricing()
+            return next((
+                pd for pd in self.payment_definitions.all()
+                if pd.type == enums.PaymentDefinitionType.REGULAR
+            ), None)
+        return self.payment_definitions.filter(type=enums.PaymentDefinitionType.REGULAR).first()
+
+    def calculate_display_price(self):
         pd = self.regular_payment_definition
         if pd:
             return pd.human_readable_price
         return ''
 
+    @property
+    def human_readable_price(self):
+        # Plans synced before display_price existed don't have it yet
+        return self.display_price or self.calculate_display_price()
+
     def activate(self):
         '''
         Activate an plan in a CREATED state.
         '''
-        obj = self.find_paypal_object()
+        obj = self.find_paypal_object(fresh=True)
         if obj.state == enums.BillingPlanState.CREATED:
             success = obj.activate()
+            self.forget_paypal_object(self.id)
             if not success:
                 raise PaypalApiError('Failed to activate plan: %r' % (obj.error))
             # Resync the updated data to the database
@@ -199,6 +264,7 @@ class PreparedBillingAgreement(models.Model):
         return ret
 
 
+@webhook_resource('agreement')
 class BillingAgreement(PaypalModel):
     name = models.CharField(max_length=128, blank=True)
     state = models.CharField(
@@ -226,20 +292,13 @@ class BillingAgreement(PaypalModel):
     end_of_period = models.DateTimeField(db_index=True)
 
     paypal_model = paypal_models.BillingAgreement
+    api_fields = {
+        'state': ApiField(converter=normalize_agreement_state),
+    }
     dashboard_url_template = (
         '{webscr}?cmd=_profile-recurring-payments&encrypted_profile_id={id}'
     )
 
-    @classmethod
-    def clean_api_data(cls, data):
-        id, cleaned_data, m2ms = super().clean_api_data(data)
-
-        # Fix inconsistent US/UK spelling
-        if 'state' in cleaned_data and cleaned_data['state'].lower() == 'canceled':
-            cleaned_data['state'] = enums.BillingAgreementState.Cancelled
-
-        return id, cleaned_data, m2ms
-
     @classmethod
     def execute(cls, token):
         if not token:
@@ -252,38 +311,54 @@ class BillingAgreement(PaypalModel):
         obj, created = cls.get_or_update_from_api_data(ba, always_sync=True)
         return obj
 
-    def save(self, **kwargs):
+    @classmethod
+    def prepare_bulk_objects(cls, objs):
         from .payer import Payer
 
-        # On save, get the payer_info object and do a best effort attempt at
-        # saving a Payer model and relation into the db.
-        payer_info = self.payer.get('payer_info', {})
-        if payer_info and 'payer_id' in payer_info:
-            # Copy the payer_info dict before mutating it
-            payer_info = payer_info.copy()
-            payer_id = payer_info.pop('payer_id')
-            payer_info['user'] = self.user
-            payer_info['livemode'] = self.livemode
-            self.payer_model, created = Payer.objects.update_or_create(
-                id=payer_id, defaults=payer_info
+        Payer.objects.link_all(objs)
+        for obj in objs:
+            obj.end_of_period = (
+                obj.calculate_end_of_period() or obj.end_of_period or NEVER_PAID_END_OF_PERIOD
             )
+        Entitlement.objects.refresh_on_commit(*objs)
+        return ('payer_model', 'end_of_period')
 
-        self.end_of_period = self.calculate_end_of_period()
-        return super().save(**kwargs)
+    def save(self, **kwargs):
+        from .payer import Payer
+
+        # On save, do a best effort attempt at saving a Payer model and
+        # relation into the db (only written when the payer data changed)
+        Payer.objects.link(self)
+
+        # Without a regular payment definition, keep the stored end_of_period
+        self.end_of_period = (
+            self.calculate_end_of_period() or self.end_of_period or NEVER_PAID_END_OF_PERIOD
+        )
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'payer_model', 'end_of_period'}
+        ret = super().save(**kwargs)
+        # Every write path (webhooks, execute(), admin edits) keeps the
+        # user's entitlement up to date
+        Entitlement.objects.refresh_on_commit(self)
+        return ret
 
     def cancel(self, note, immediately=False):
-        obj = self.find_paypal_object()
+        obj = self.find_paypal_object(fresh=True)
         obj.cancel({'note': note})
+        self.forget_paypal_object(self.id)
         # Sync updated object back to to the database
         obj, created = self.get_or_update_from_api_data(obj, always_sync=True)
         if immediately:
-            obj.end_of_period = datetime.now()
-            obj.save()
+            # save() would recalculate end_of_period, so update the column only
+            obj.end_of_period = now()
+            type(obj).objects.filter(pk=obj.pk).update(end_of_period=obj.end_of_period)
+            Entitlement.objects.refresh(obj)
         return obj
 
     def suspend(self, note):
-        obj = self.find_paypal_object()
+        obj = self.find_paypal_object(fresh=True)
         obj.suspend({'note': note})
+        self.forget_paypal_object(self.id)
         # Sync updated object back to to the database
         obj, created = self.get_or_update_from_api_data(obj, always_sync=True)
         return obj
@@ -292,24 +367,112 @@ class BillingAgreement(PaypalModel):
     def last_payment_date(self):
         date = self.agreement_details.get('last_payment_date', '')
         if date:
-            return parse(date)
+            return parse_datetime(date)
+
+    def get_regular_delta(self):
+        '''
+        Returns the billing period of the plan's regular payment definition,
+        or None if it doesn't have one
+        '''
+        rpd = next(filter(
+            lambda pd: pd.get('type') == enums.PaymentDefinitionType.REGULAR,
+            (self.plan or {}).get('payment_definitions') or []
+        ), None)
+        if rpd is None:
+            return None
+
+        # Memoized, so agreements of the same period share one relativedelta
+        return get_frequency_delta(rpd['frequency'].upper(), int(rpd['frequency_interval']))
 
     def calculate_end_of_period(self):
+        '''
+        Returns the end of the period paid by the last payment, or None if
+        the plan has no regular payment definition to derive it from.
+        '''
         # The next payment date is not reliably set.
         # When a subscription is cancelled, we do not have access to it anymore...
         # So instead, keep the end_of_period attribute up to date.
         last_payment_date = self.last_payment_date
         if not last_payment_date:
-            return parse('1970-01-01T00:00:00Z')
-
-        rpd = next(filter(
-            lambda pd: pd['type'] == enums.PaymentDefinitionType.REGULAR,
-            self.plan['payment_definitions']
-        ))
+            return NEVER_PAID_END_OF_PERIOD
 
-        delta = get_frequency_delta(rpd['frequency'], int(rpd['frequency_interval']))
+        delta = self.get_regular_delta()
+        if delta is None:
+            return None
         return last_payment_date + delta
 
+    @classmethod
+    def recompute_end_of_period(cls, queryset=None, batch_size=PAYPAL_SUBS_SYNC_BATCH_SIZE):
+        '''
+        Recalculates end_of_period of the agreements in `queryset` (all of
+        them by default) in chunks of `batch_size`, writing only the
+        changed ones with bulk_update. Returns the number of changed
+        agreements.
+        '''
+        if queryset is None:
+            queryset = cls.objects.all()
+        queryset = queryset.only(
+            'id', 'agreement_details', 'plan', 'end_of_period',
+            # For the entitlements
+            'user', 'plan_model', 'livemode', 'state',
+        ).order_by('pk')
+
+        changed = 0
+        last_pk = None
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            chunk = list(chunk[:batch_size])
+            if not chunk:
+                return changed
+            last_pk = chunk[-1].pk
+
+            to_update = []
+            for agreement in chunk:
+                end_of_period = agreement.calculate_end_of_period()
+                if end_of_period is None:
+                    # No regular payment definition, leave it as it is
+                    continue
+                if end_of_period != agreement.end_of_period:
+                    agreement.end_of_period = end_of_period
+                    to_update.append(agreement)
+            if to_update:
+                cls.objects.bulk_update(to_update, ['end_of_period'])
+                Entitlement.objects.refresh(*to_update)
+            changed += len(to_update)
+
+    @classmethod
+    def sweep_expired(cls, until=None, since=None):
+        '''
+        Finds the agreements whose end_of_period passed between the previous
+        sweep (or `since`) and `until` (now by default), using the
+        end_of_period index, and sends billing_agreements_expired once per
+        livemode. The first sweep without `since` only records `until`.
+        Returns the number of expired agreements.
+        '''
+        until = until or now()
+        count = 0
+        for livemode in (True, False):
+            state, created = SweepState.objects.get_or_create(
+                name=cls._meta.label_lower + '.expired', livemode=livemode
+            )
+            start = since or state.watermark
+            if start is not None:
+                agreements = cls.objects.filter(
+                    livemode=livemode, end_of_period__gt=start, end_of_period__lte=until
+                )
+                found = agreements.count()
+                if found:
+                    billing_agreements_expired.send(
+                        sender=cls, agreements=agreements, livemode=livemode
+                    )
+                count += found
+                state.last_swept_count = found
+
+            state.watermark = until
+            state.last_swept = now()
+            state.save()
+        return count
+
 
 class PaymentDefinition(PaypalModel):
     name = models.CharField(max_length=128)
@@ -323,17 +486,17 @@ class PaymentDefinition(PaypalModel):
 
     charge_models = models.ManyToManyField('ChargeModel')
 
-    @classmethod
-    def clean_api_data(cls, data):
-        id, cleaned_data, m2ms = super().clean_api_data(data)
-
-        cleaned_data['frequency'] = cleaned_data['frequency'].upper()
-        if 'charge_models' in cleaned_data:
-            charge_models = cleaned_data.pop('charge_models')
-            # Sync payment definitions but do not fetch them (we have them in full)
-            m2ms['charge_models'] = ChargeModel.objects.sync_data(charge_models, fetch=False)
+    api_fields = {
+        'frequency': ApiField(converter=str.upper),
+    }
+    nested_m2ms = ('charge_models', )
 
-        return id, cleaned_data, m2ms
+    @classmethod
+    def finish_bulk_upsert(cls, pks):
+        # The plans using these definitions may display another price now
+        BillingPlan.refresh_display_prices(
+            BillingPlan.objects.filter(payment_definitions__in=pks).distinct()
+        )
 
     @property
     def human_readable_price(self):
@@ -3,8 +3,10 @@ from django.db import models
 from .. import enums
 from ..fields import CurrencyAmountField, JSONField
 from .base import PaypalModel
+from .webhooks import webhook_resource
 
 
+@webhook_resource('dispute')
 class Dispute(PaypalModel):
     dispute_id = models.CharField(
         max_length=128, primary_key=True, editable=False, serialize=True
@@ -0,0 +1,272 @@
+import logging
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import models, transaction
+from django.utils.timezone import now
+
+from .. import enums
+from ..constants import SUBSCRIPTION_STATUS_ACTIVE
+from ..settings import (
+    PAYPAL_SUBS_ENTITLEMENT_CACHE, PAYPAL_SUBS_ENTITLEMENT_CACHE_TTL,
+    PAYPAL_SUBS_SYNC_BATCH_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+ENTITLEMENT_SOURCE_AGREEMENT = 'agreement'
+ENTITLEMENT_SOURCE_SUBSCRIPTION = 'subscription'
+
+ENTITLEMENT_SOURCE_CHOICES = [
+    (ENTITLEMENT_SOURCE_AGREEMENT, 'Billing agreement'),
+    (ENTITLEMENT_SOURCE_SUBSCRIPTION, 'Subscription'),
+]
+
+
+# Agreements in these states entitle their user to the plan until
+# end_of_period: cancelled and completed agreements were paid up to then.
+# Suspended agreements (paused by the merchant, or by PayPal after failed
+# payments) and agreements that were never activated don't entitle.
+ENTITLING_AGREEMENT_STATES = {
+    state.lower() for state in (
+        enums.BillingAgreementState.Active,
+        enums.BillingAgreementState.Reactivated,
+        enums.BillingAgreementState.Cancelled,
+        enums.BillingAgreementState.Completed,
+    )
+}
+
+
+class EntitlementManager(models.Manager):
+    cache_prefix = 'djpp:entitlements:'
+
+    @property
+    def cache(self):
+        if PAYPAL_SUBS_ENTITLEMENT_CACHE:
+            return caches[PAYPAL_SUBS_ENTITLEMENT_CACHE]
+
+    @staticmethod
+    def source_of(obj):
+        from .billing import BillingAgreement
+
+        if isinstance(obj, BillingAgreement):
+            return ENTITLEMENT_SOURCE_AGREEMENT
+        return ENTITLEMENT_SOURCE_SUBSCRIPTION
+
+    def entitlement_for(self, obj, payer_users=None):
+        '''
+        Returns an unsaved Entitlement for obj (a BillingAgreement or a
+        Subscription), or None if it doesn't belong to a known user.
+        `payer_users` optionally maps payer ids to user ids.
+        '''
+        if self.source_of(obj) == ENTITLEMENT_SOURCE_AGREEMENT:
+            # Agreements entitle to the plan until the end of the paid period
+            return self.model(
+                user_id=obj.user_id, source=ENTITLEMENT_SOURCE_AGREEMENT, source_id=obj.pk,
+                plan_id=obj.plan_model_id or (obj.plan or {}).get('id', ''),
+                livemode=obj.livemode,
+                is_active=(obj.state or '').lower() in ENTITLING_AGREEMENT_STATES,
+                active_until=obj.end_of_period,
+            ) if obj.user_id else None
+
+        # Subscriptions belong to the user of their payer
+        payer_id = (obj.subscriber or {}).get('payer_id')
+        if not payer_id:
+            return None
+        if payer_users is None:
+            from .payer import Payer
+            user_id = Payer.objects.filter(pk=payer_id).values_list('user_id', flat=True).first()
+        else:
+            user_id = payer_users.get(payer_id)
+        if not user_id:
+            return None
+        return self.model(
+            user_id=user_id, source=ENTITLEMENT_SOURCE_SUBSCRIPTION, source_id=obj.pk,
+            plan_id=obj.plan_id, livemode=obj.livemode,
+            is_active=obj.status == SUBSCRIPTION_STATUS_ACTIVE, active_until=None,
+        )
+
+    def refresh(self, *objs):
+        '''
+        Updates the entitlements of objs (BillingAgreements and
+        Subscriptions; other objects are ignored) and drops the cached
+        entitlements of their users
+        '''
+        from .billing import BillingAgreement
+        from .payer import Payer
+        from .subscriptions import Subscription
+
+        objs = [obj for obj in objs if isinstance(obj, (BillingAgreement, Subscription))]
+        if not objs:
+            return []
+
+        payer_ids = {(getattr(obj, 'subscriber', None) or {}).get('payer_id') for obj in objs}
+        payer_users = dict(
+            Payer.objects.filter(pk__in=payer_ids - {None}).values_list('pk', 'user_id')
+        )
+        entitlements = [
+            entitlement for entitlement in (self.entitlement_for(obj, payer_users) for obj in objs)
+            if entitlement is not None
+        ]
+
+        keys = models.Q()
+        for obj in objs:
+            keys |= models.Q(source=self.source_of(obj), source_id=obj.pk)
+        wanted = {(e.source, e.source_id): e for e in entitlements}
+        fields = ['user', 'plan_id', 'livemode', 'is_active', 'active_until', 'updated']
+        timestamp = now()
+
+        # Concurrent refreshes of the same objects (e.g. a burst of webhooks)
+        # must not both insert: insert what's missing ignoring conflicts,
+        # then update the locked rows.
+        with transaction.atomic():
+            existing = {
+                (source, source_id): (pk, user_id) for pk, source, source_id, user_id in
+                self.select_for_update().filter(keys)
+                .values_list('pk', 'source', 'source_id', 'user_id')
+            }
+            user_ids = {user_id for pk, user_id in existing.values()}
+            stale = [pk for key, (pk, user_id) in existing.items() if key not in wanted]
+            if stale:
+                self.filter(pk__in=stale).delete()
+
+            missing = [e for key, e in wanted.items() if key not in existing]
+            if missing:
+                self.bulk_create(missing, ignore_conflicts=True)
+                # Rows inserted by us or, concurrently, by someone else; all
+                # of them get our values
+                created = models.Q()
+                for e in missing:
+                    created |= models.Q(source=e.source, source_id=e.source_id)
+                existing.update({
+                    (source, source_id): (pk, None) for pk, source, source_id in
+                    self.select_for_update().filter(created).values_list('pk', 'source', 'source_id')
+                })
+
+            # Every wanted row exists now, unless a concurrent refresh deleted it
+            to_update = [e for key, e in wanted.items() if key in existing]
+            for entitlement in to_update:
+                entitlement.pk = existing[entitlement.source, entitlement.source_id][0]
+                entitlement.updated = timestamp
+            if to_update:
+                self.bulk_update(to_update, fields)
+        self.invalidate(*user_ids.union(e.user_id for e in entitlements))
+        return entitlements
+
+    def refresh_on_commit(self, *objs):
+        '''
+        Refreshes the entitlements of objs once the current transaction is
+        committed. Errors are logged instead of raised, as the changes of
+        objs are committed by then; djpp_rebuild_entitlements repairs the
+        entitlements they left out of date.
+        '''
+        transaction.on_commit(partial(self._refresh_committed, objs))
+
+    def _refresh_committed(self, objs):
+        try:
+            self.refresh(*objs)
+        except Exception:
+            logger.exception('Failed to refresh the entitlements of %r', objs)
+
+    def rebuild(self, batch_size=PAYPAL_SUBS_SYNC_BATCH_SIZE):
+        '''
+        Recreates all entitlements from the stored agreements and
+        subscriptions. Returns the number of entitlements.
+        '''
+        from .billing import BillingAgreement
+        from .payer import Payer
+        from .subscriptions import Subscription
+
+        payer_users = dict(
+            Payer.objects.filter(user__isnull=False).values_list('pk', 'user_id')
+        )
+        entitlements = []
+        for queryset in (
+            BillingAgreement.objects.filter(user__isnull=False).only(
+                'id', 'user', 'plan_model', 'plan', 'livemode', 'state', 'end_of_period'
+            ),
+            Subscription.objects.only('id', 'plan', 'subscriber', 'livemode', 'status'),
+        ):
+            for obj in queryset.iterator(chunk_size=batch_size):
+                entitlement = self.entitlement_for(obj, payer_users)
+                if entitlement is not None:
+                    entitlements.append(entitlement)
+
+        with transaction.atomic():
+            user_ids = set(self.values_list('user_id', flat=True).distinct())
+            self.all().delete()
+            self.bulk_create(entitlements, batch_size=batch_size)
+        self.invalidate(*user_ids.union(e.user_id for e in entitlements))
+        return len(entitlements)
+
+    def invalidate(self, *user_ids):
+        cache = self.cache
+        if cache is not None and user_ids:
+            cache.delete_many([self.cache_prefix + str(pk) for pk in user_ids])
+
+    def for_users(self, user_ids):
+        '''
+        Returns {user id: [active entitlements]}, read from the cache when
+        possible and with one query for the rest
+        '''
+        user_ids = set(user_ids)
+        cache = self.cache
+        found = {}
+        if cache is not None:
+            cached = cache.get_many([self.cache_prefix + str(pk) for pk in user_ids])
+            found = {
+                pk: cached[self.cache_prefix + str(pk)]
+                for pk in user_ids if self.cache_prefix + str(pk) in cached
+            }
+
+        missing = user_ids - set(found)
+        if missing:
+            loaded = {pk: [] for pk in missing}
+            # Entitlements that can still be active; the date is checked on read
+            for entitlement in self.filter(user_id__in=missing, is_active=True):
+                loaded[entitlement.user_id].append(entitlement)
+            if cache is not None:
+                cache.set_many({
+                    self.cache_prefix + str(pk): entitlements
+                    for pk, entitlements in loaded.items()
+                }, timeout=PAYPAL_SUBS_ENTITLEMENT_CACHE_TTL)
+            found.update(loaded)
+
+        timestamp = now()
+        return {
+            pk: [e for e in entitlements if e.active_until is None or e.active_until > timestamp]
+            for pk, entitlements in found.items()
+        }
+
+
+class Entitlement(models.Model):
+    '''
+    A compact, denormalized record of which plan a user is entitled to
+    through one billing agreement or subscription, kept up to date by
+    webhooks. Use the functions of djpp.entitlements to query it.
+    '''
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='paypal_entitlements'
+    )
+    source = models.CharField(max_length=12, choices=ENTITLEMENT_SOURCE_CHOICES)
+    source_id = models.CharField(max_length=128)
+    plan_id = models.CharField(max_length=128, blank=True)
+    # Copied from the agreement/subscription, where it may be unknown
+    livemode = models.BooleanField(null=True, default=None, blank=True)
+    is_active = models.BooleanField()
+    active_until = models.DateTimeField(
+        null=True, blank=True, help_text='Empty if active until further notice'
+    )
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = EntitlementManager()
+
+    class Meta:
+        unique_together = ('source', 'source_id')
+        index_together = ('user', 'is_active')
+
+    def __str__(self):
+        return '{} ({} {})'.format(self.plan_id, self.source, self.source_id)
@@ -1,6 +1,7 @@
 from django.db import models
 
 from .base import PaypalModel
+from .webhooks import webhook_resource
 from ..constants import (
     ORDER_INTENT_CHOICES, ORDER_STATUS_CHOICES,
     CAPTURE_STATUS_CHOICES, DISBURSEMENT_MODE_CHOICES,
@@ -8,6 +9,7 @@ from ..constants import (
 from ..fields import JSONField, CurrencyAmountField
 
 
+@webhook_resource('checkout-order')
 class CheckoutOrder(PaypalModel):
     '''
     https://developer.paypal.com/docs/api/orders/v2/#orders
@@ -25,24 +27,25 @@ class CheckoutOrder(PaypalModel):
         'Payer', on_delete=models.SET_NULL, null=True, blank=True,
     )
 
+    @classmethod
+    def prepare_bulk_objects(cls, objs):
+        from .payer import Payer
+
+        Payer.objects.link_all(objs)
+        return ('payer_model', )
+
     def save(self, **kwargs):
         from .payer import Payer
 
-        # On save, get the payer_info object and do a best effort attempt at
-        # saving a Payer model and relation into the db.
-        payer_info = self.payer.get('payer_info', {})
-        if payer_info and 'payer_id' in payer_info:
-            # Copy the payer_info dict before mutating it
-            payer_info = payer_info.copy()
-            payer_id = payer_info.pop('payer_id')
-            payer_info['user'] = self.user
-            payer_info['livemode'] = self.livemode
-            self.payer_model, created = Payer.objects.update_or_create(
-                id=payer_id, defaults=payer_info
-            )
+        # On save, do a best effort attempt at saving a Payer model and
+        # relation into the db (only written when the payer data changed)
+        Payer.objects.link(self)
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'payer_model'}
         return super().save(**kwargs)
 
 
+@webhook_resource('capture')
 class Capture(PaypalModel):
     '''
     https://developer.paypal.com/docs/api/orders/v2/#definition-capture
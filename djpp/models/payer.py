@@ -1,9 +1,171 @@
+import hashlib
+import json
+import threading
+from contextlib import contextmanager
+
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.utils.timezone import now
 
 from ..constants import APIMODE_CHOICES
 from ..fields import JSONField
 
+_memo = threading.local()
+
+
+@contextmanager
+def payer_memo():
+    '''
+    Within this block, a payer is only written once per content, e.g. when
+    several objects of the same webhook refer to it.
+    '''
+    outer = getattr(_memo, 'hashes', None)
+    if outer is None:
+        _memo.hashes = {}
+    try:
+        yield
+    finally:
+        if outer is None:
+            del _memo.hashes
+
+
+class PayerManager(models.Manager):
+    # Payer fields that are read from payer_info (v1 API)
+    info_fields = ('first_name', 'last_name', 'email', 'shipping_address')
+
+    def parse_payer(self, payer):
+        '''
+        Returns (payer_id, field values) from the payer object of a v1
+        (payer_info) or v2 (name, email_address...) API resource,
+        or (None, None) if it doesn't identify a payer
+        '''
+        payer = payer or {}
+        if 'payer_info' in payer:
+            info = payer['payer_info'] or {}
+            fields = {k: info[k] for k in self.info_fields if k in info}
+        else:
+            info = payer
+            name = payer.get('name') or {}
+            fields = {
+                'first_name': name.get('given_name'),
+                'last_name': name.get('surname'),
+                'email': payer.get('email_address'),
+                'shipping_address': payer.get('address'),
+            }
+            fields = {k: v for k, v in fields.items() if v is not None}
+
+        if not info.get('payer_id'):
+            return None, None
+        return info['payer_id'], fields
+
+    def _payer_fields(self, obj):
+        '''
+        (payer_id, field values, content hash) for the payer of obj. The
+        hash only covers the payer data, so it's the same whichever kind of
+        object the payer is linked from; see _user_fields().
+        '''
+        payer_id, fields = self.parse_payer(obj.payer)
+        if payer_id is None:
+            return None, None, None
+
+        fields['livemode'] = obj.livemode
+        content = json.dumps(fields, sort_keys=True, default=str)
+        return payer_id, fields, hashlib.sha1(content.encode()).hexdigest()
+
+    @staticmethod
+    def _user_fields(obj):
+        '''
+        {'user_id': ...} for objects that have a user (billing agreements):
+        the most recent user that transacted as this payer. Empty for the
+        others (checkout orders), which leave the payer's user as it is.
+        '''
+        if hasattr(obj, 'user_id'):
+            return {'user_id': obj.user_id}
+        return {}
+
+    def link(self, obj):
+        '''
+        Creates or updates the Payer of obj (a BillingAgreement or a
+        CheckoutOrder) and sets obj.payer_model_id. The payer is only
+        written if its content hash differs from the stored one, or if obj
+        links it to another user.
+        '''
+        payer_id, fields, content_hash = self._payer_fields(obj)
+        if payer_id is None:
+            return None
+        user_fields = self._user_fields(obj)
+
+        obj.payer_model_id = payer_id
+        memo = getattr(_memo, 'hashes', None)
+        written = memo.get(payer_id) if memo is not None else None
+        if written is not None and written[0] == content_hash \
+                and (not user_fields or written[1] == user_fields):
+            return payer_id
+
+        stored = self.filter(pk=payer_id).values_list('content_hash', 'user_id').first()
+        changes = {}
+        if stored is None:
+            try:
+                with transaction.atomic():
+                    self.create(id=payer_id, content_hash=content_hash, **fields, **user_fields)
+            except IntegrityError:
+                # Created concurrently
+                changes = dict(fields, content_hash=content_hash, **user_fields)
+        else:
+            stored_hash, stored_user_id = stored
+            if stored_hash != content_hash:
+                changes.update(fields, content_hash=content_hash)
+            if user_fields and user_fields['user_id'] != stored_user_id:
+                changes.update(user_fields)
+        if changes:
+            self.filter(pk=payer_id).update(updated=now(), **changes)
+
+        if memo is not None:
+            memo[payer_id] = (content_hash, user_fields)
+        return payer_id
+
+    def link_all(self, objs):
+        '''
+        Bulk version of link(): writes the payers of objs with one SELECT,
+        at most one INSERT and one UPDATE
+        '''
+        rows = {}
+        for obj in objs:
+            payer_id, fields, content_hash = self._payer_fields(obj)
+            if payer_id is not None:
+                obj.payer_model_id = payer_id
+                rows[payer_id] = (fields, content_hash, self._user_fields(obj))
+        if not rows:
+            return
+
+        timestamp = now()
+        to_create, to_update, update_fields = [], [], {'content_hash', 'updated'}
+        existing = self.in_bulk(list(rows))
+        for payer_id, (fields, content_hash, user_fields) in rows.items():
+            payer = existing.get(payer_id)
+            if payer is None:
+                to_create.append(self.model(
+                    id=payer_id, content_hash=content_hash, **fields, **user_fields
+                ))
+                continue
+            changes = {}
+            if payer.content_hash != content_hash:
+                changes.update(fields, content_hash=content_hash)
+            if user_fields and user_fields['user_id'] != payer.user_id:
+                changes.update(user_fields)
+            if not changes:
+                continue
+            for k, v in changes.items():
+                setattr(payer, k, v)
+                update_fields.add(self.model._meta.get_field(k).name)
+            payer.updated = timestamp
+            to_update.append(payer)
+
+        if to_create:
+            self.bulk_create(to_create, ignore_conflicts=True)
+        if to_update:
+            self.bulk_update(to_update, update_fields)
+
 
 class Payer(models.Model):
     id = models.CharField(max_length=13, primary_key=True)
@@ -25,10 +187,14 @@ class Payer(models.Model):
         'previously unrecorded. Otherwise, this field indicates whether this record '
         'comes from Stripe test mode or live mode operation.',
     )
+    # Hash of the payer data last written, to skip writes when nothing changed
+    content_hash = models.CharField(max_length=40, blank=True, default='', editable=False)
 
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    objects = PayerManager()
+
     def __str__(self):
         return "{first_name} {last_name} <{email}>".format(
             first_name=self.first_name, last_name=self.last_name, email=self.email
@@ -2,8 +2,10 @@ from django.db import models
 from paypalrestsdk import payments as paypal_models
 
 from .. import enums
+from ..cleaners import ApiField
 from ..fields import CurrencyAmountField, JSONField
 from .base import PaypalModel
+from .webhooks import webhook_resource
 
 
 class Payment(PaypalModel):
@@ -29,6 +31,7 @@ class Payment(PaypalModel):
         return base_url + self.id
 
 
+@webhook_resource('refund')
 class Refund(PaypalModel):
     deferred_attrs = ['sale_id', 'parent_payment_id']
 
@@ -97,22 +100,17 @@ class Refund(PaypalModel):
     )
 
     paypal_model = paypal_models.Refund
+    api_fields = {
+        'parent_payment_id': ApiField(source='parent_payment'),
+    }
+    dependencies = ('sale', 'parent_payment')
     dashboard_url_template = '{paypal}/activity/payment/{id}'
 
-    @classmethod
-    def clean_api_data(cls, data):
-        id, cleaned_data, m2ms = super().clean_api_data(data)
-
-        if 'sale_id' in cleaned_data:
-            sale_id = cleaned_data['sale_id']
-            # Ensure that the refunded sale exists in the db
-            # If it exists, it will be updated with new data
-            Sale.find_and_sync(sale_id)
-
-        return id, cleaned_data, m2ms
-
 
+@webhook_resource('sale')
 class Sale(PaypalModel):
+    deferred_attrs = ['parent_payment_id']
+
     amount = CurrencyAmountField(editable=False)
     payment_mode = models.CharField(
         max_length=20, choices=enums.SalePaymentMode.choices, editable=False
@@ -152,33 +150,12 @@ class Sale(PaypalModel):
     )
 
     paypal_model = paypal_models.Sale
+    # The API calls parent_payment_id parent_payment
+    api_fields = {
+        'parent_payment_id': ApiField(source='parent_payment'),
+    }
+    # The billing agreement isn't a dependency: the billing agreements endpoint
+    # has been deprecated
+    # https://developer.paypal.com/docs/api/payments.billing-agreements/v1/
+    dependencies = ('parent_payment',)
     dashboard_url_template = '{paypal}/activity/payment/{id}'
-
-    @classmethod
-    def clean_api_data(cls, data):
-
-        id, cleaned_data, m2ms = super().clean_api_data(data)
-
-        # Billing agreements endpoint has been recently deprecated
-        # https://developer.paypal.com/docs/api/payments.billing-agreements/v1/
-
-        # from .billing import BillingAgreement
-        # if 'billing_agreement_id' in cleaned_data:
-        #     ba_id = cleaned_data['billing_agreement_id']
-        #     # Ensure that the billing agreement exists in the db
-        #     # If it exists, it will be updated with new data
-        #     BillingAgreement.find_and_sync(ba_id)
-
-        # Ensure the parent payment exists in the db
-        if 'parent_payment' in cleaned_data:
-            pp_id = cleaned_data['parent_payment']
-            try:
-                Payment.objects.get(id=pp_id)
-            except Payment.DoesNotExist:
-                Payment.find_and_sync(pp_id)
-
-            # Replace the parent_payment in the cleaned data with parent_payment_id
-            cleaned_data['parent_payment_id'] = pp_id
-            del cleaned_data['parent_payment']
-
-        return id, cleaned_data, m2ms
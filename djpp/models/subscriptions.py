@@ -2,6 +2,8 @@ from django.contrib.postgres.fields import JSONField
 from django.db import models
 
 from .base import PaypalModel
+from .entitlements import Entitlement
+from .webhooks import webhook_resource
 from ..constants import (
     PRODUCTS_ENDPOINT, PRODUCT_TYPES,
     PLANS_ENDPOINT, PLAN_STATUS_CHOICES,
@@ -9,6 +11,7 @@ from ..constants import (
 )
 
 
+@webhook_resource('product')
 class Product(PaypalModel):
     '''https://developer.paypal.com/docs/api/catalog-products/v1/#products'''
     endpoint = PRODUCTS_ENDPOINT
@@ -21,6 +24,8 @@ class Product(PaypalModel):
     home_url = models.URLField(blank=True, max_length=2000)
 
 
+@webhook_resource('plan')
+@webhook_resource('plan', version='2.0')
 class Plan(PaypalModel):
     '''https://developer.paypal.com/docs/api/subscriptions/v1/#plans'''
     endpoint = PLANS_ENDPOINT
@@ -39,6 +44,7 @@ class Plan(PaypalModel):
     quantity_supported = models.BooleanField(default=False)
 
 
+@webhook_resource('subscription')
 class Subscription(PaypalModel):
     '''https://developer.paypal.com/docs/api/subscriptions/v1/#subscriptions'''
     endpoint = SUBSCRIPTIONS_ENDPOINT
@@ -56,3 +62,9 @@ class Subscription(PaypalModel):
     subscriber = JSONField(blank=True, null=True)
     billing_info = JSONField(blank=True, null=True)
     application_context = JSONField(blank=True, null=True)  # not returned
+
+    def save(self, **kwargs):
+        ret = super().save(**kwargs)
+        # Keep the entitlement of the subscriber's user up to date
+        Entitlement.objects.refresh_on_commit(self)
+        return ret
@@ -0,0 +1,50 @@
+from django.db import models
+
+
+class SyncState(models.Model):
+    '''
+    Remembers how far the data of a model has been downloaded from PayPal
+    for each livemode, so that following syncs can be incremental.
+    '''
+    model = models.CharField(max_length=64)
+    livemode = models.BooleanField()
+    watermark = models.DateTimeField(
+        null=True, blank=True,
+        help_text='The newest update_time of all objects synced so far'
+    )
+    last_synced = models.DateTimeField(null=True, blank=True)
+    last_synced_count = models.PositiveIntegerField(default=0)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('model', 'livemode')
+
+    def __str__(self):
+        return '{} ({})'.format(self.model, 'live' if self.livemode else 'sandbox')
+
+
+class SweepState(models.Model):
+    '''
+    Remembers up to when a periodic sweep over stored rows (e.g.
+    BillingAgreement.sweep_expired) has run for each livemode, so that the
+    next sweep starts where the previous one stopped.
+    '''
+    name = models.CharField(max_length=64)
+    livemode = models.BooleanField()
+    watermark = models.DateTimeField(
+        null=True, blank=True,
+        help_text='The end of the period covered by the previous sweep'
+    )
+    last_swept = models.DateTimeField(null=True, blank=True)
+    last_swept_count = models.PositiveIntegerField(default=0)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('name', 'livemode')
+
+    def __str__(self):
+        return '{} ({})'.format(self.name, 'live' if self.livemode else 'sandbox')
@@ -1,16 +1,28 @@
 import json
-from fnmatch import fnmatch
+from datetime import timedelta
 from traceback import format_exc
 
 from django.contrib.postgres.fields import JSONField
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q
 from django.dispatch import Signal
 from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+from django.utils.timezone import now
 from paypalrestsdk import notifications as paypal_models
 
-from ..settings import PAYPAL_SUBS_WEBHOOK_ID
+from ..settings import (
+    PAYPAL_SUBS_WEBHOOK_ID, PAYPAL_SUBS_WEBHOOK_QUEUE_BACKEND,
+    PAYPAL_SUBS_WEBHOOK_MAX_ATTEMPTS, PAYPAL_SUBS_WEBHOOK_RETRY_BACKOFF,
+    PAYPAL_SUBS_WEBHOOK_VERIFY_LOCALLY, PAYPAL_SUBS_WEBHOOK_ROBUST_HANDLERS,
+    PAYPAL_SUBS_WEBHOOK_IN_FLIGHT_TIMEOUT,
+)
+from ..dedup import seen_webhooks
+from ..dispatch import WebhookDispatcher
+from ..signatures import verify_webhook_signature
 from ..utils import fix_django_headers, get_version
 from .base import PaypalModel
+from .payer import payer_memo
 
 # https://developer.paypal.com/docs/api-basics/notifications/webhooks/event-names/#
 WEBHOOK_EVENT_TYPES = {
@@ -70,26 +82,26 @@ WEBHOOK_EVENT_TYPES = {
     # Orders
 
     # v2
-    'checkout.order.completed'
+    'checkout.order.completed',
     # 'checkout.order.approved'  # listed above
 
     # v1
-    'checkout.order.processed'
+    'checkout.order.processed',
 
 
     # PayPal Commerce Platform
     # 'checkout.order.processed'  # listed above
-    'customer.account-limitation.added'
-    'customer.account-limitation.escalated'
-    'customer.account-limitation.lifted'
-    'customer.account-limitation.updated'
+    'customer.account-limitation.added',
+    'customer.account-limitation.escalated',
+    'customer.account-limitation.lifted',
+    'customer.account-limitation.updated',
     # 'merchant.onboarding.completed'  # listed above
     # 'merchant.partner-consent.revoked'  # listed above
     # 'payment.capture.completed'  # listed above
     # 'payment.capture.denied'  # listed above
     # 'payment.capture.refunded'  # listed above
-    'payment.referenced-payout-item.completed'
-    'payment.referenced-payout-item.failed'
+    'payment.referenced-payout-item.completed',
+    'payment.referenced-payout-item.failed',
 
     # Payment orders
     'payment.order.cancelled',
@@ -152,6 +164,19 @@ WEBHOOK_SIGNALS = {
 
 webhook_error = Signal(providing_args=["exception"])
 
+# Sent when a robust or deferred webhook handler raises
+webhook_handler_error = Signal(providing_args=["handler", "exception", "event"])
+
+
+def _send_handler_error(handler, exception, kwargs):
+    webhook_handler_error.send(
+        sender=kwargs.get("sender"), handler=handler, exception=exception, event=kwargs.get("event")
+    )
+
+
+# Handlers registered with @webhook_handler
+webhook_dispatcher = WebhookDispatcher(on_error=_send_handler_error)
+
 
 class WebhookEvent(PaypalModel):
     event_version = models.CharField(max_length=8, editable=False)
@@ -160,6 +185,7 @@ class WebhookEvent(PaypalModel):
     resource_type = models.CharField(max_length=64, editable=False)
     resource_version = models.CharField(max_length=8, blank=True, editable=False)
     resource = JSONField(editable=False)
+    resource_id = models.CharField(max_length=128, blank=True, db_index=True, editable=False)
     status = models.CharField(max_length=64, blank=True, editable=False)
     summary = models.CharField(max_length=256, editable=False)
     transmissions = JSONField(null=True, blank=True, editable=False)
@@ -171,51 +197,60 @@ class WebhookEvent(PaypalModel):
 
     @classmethod
     def process(cls, data):
-        ret, created = cls.get_or_update_from_api_data(data)
-        resource, resource_created = ret.create_or_update_resource()
-        # if resource_created:
-        ret.send_signal(created=resource_created)
+        # Objects of one webhook often refer to the same payer; write it once
+        with payer_memo():
+            ret, created = cls.get_or_update_from_api_data(data)
+            # Whatever the API returned for the resource before is outdated now
+            if ret.resource_model is not None and ret.resource_id:
+                ret.resource_model.forget_paypal_object(ret.resource_id)
+            resource, resource_created = ret.create_or_update_resource()
+            # if resource_created:
+            ret.handler_outcomes = ret.send_signal(created=resource_created)
         return ret
 
-    @property
-    def resource_model(self):
-        resource_type = self.resource_type.lower()
-        if resource_type == 'product':
-            from .subscriptions import Product
-            return Product
-        elif resource_type == 'plan':
-            from .subscriptions import Plan
-            return Plan
-        elif resource_type == 'subscription':
-            from .subscriptions import Subscription
-            return Subscription
-        elif resource_type == 'agreement':
-            from .billing import BillingAgreement
-            return BillingAgreement
-        elif resource_type == 'dispute':
-            from .disputes import Dispute
-            return Dispute
-        elif resource_type == 'plan':
-            from .billing import BillingPlan
-            return BillingPlan
-        elif resource_type == 'refund':
-            from .payments import Refund
-            return Refund
-        elif resource_type == 'sale':
-            from .payments import Sale
-            return Sale
-        elif resource_type == 'checkout-order':
-            from .orders import CheckoutOrder
-            return CheckoutOrder
-        elif resource_type == 'capture':
-            from .orders import Capture
-            return Capture
-        raise NotImplementedError("Unimplemented webhook resource: %r" % (self.resource_type))
+    @classmethod
+    def clean_api_data(cls, data):
+        id, cleaned_data, m2ms = super().clean_api_data(data)
+
+        # Store the resource id in its own column, so it can be indexed
+        model = get_webhook_resource_model(
+            cleaned_data.get("resource_type"), cleaned_data.get("resource_version"),
+            cleaned_data.get("event_version"),
+        )
+        id_field_name = model.id_field_name if model else "id"
+        cleaned_data["resource_id"] = (cleaned_data.get("resource") or {}).get(id_field_name) or ""
+        return id, cleaned_data, m2ms
+
+    @classmethod
+    def prefetch_resources(cls, events):
+        """
+        Load the resources of `events` with one query per resource model,
+        so that get_resource() doesn't have to query them one by one.
+        """
+        ids_by_model = {}
+        for event in events:
+            model = event.resource_model
+            if model is not None and event.resource_id:
+                ids_by_model.setdefault(model, set()).add(event.resource_id)
+
+        resources = {}
+        for model, ids in ids_by_model.items():
+            lookup = {model.id_field_name + "__in": ids}
+            for obj in model.objects.filter(**lookup):
+                resources[model, getattr(obj, model.id_field_name)] = obj
+
+        for event in events:
+            event._resource_cache = resources.get((event.resource_model, event.resource_id))
 
     @property
-    def resource_id(self):
-        cls = self.resource_model
-        return self.resource[cls.id_field_name]
+    def resource_model(self):
+        """
+        The model the resource is stored in, or None for resource types
+        without a registered model (see webhook_resource).
+        """
+        return get_webhook_resource_model(
+            self.resource_type, self.resource_version, self.event_version
+        )
 
     def create_or_update_resource(self):
         if self.event_type.lower().startswith("risk.dispute."):
@@ -224,20 +259,40 @@ class WebhookEvent(PaypalModel):
             # TODO: Get/Create the actual dispute object.
             # Depends on SDK implementation which is currently missing:
             # https://github.com/paypal/PayPal-Python-SDK/issues/216
-            return
+            return None, False
 
         model = self.resource_model
+        if model is None:
+            # Unknown resource; the event itself is still stored
+            return None, False
         return model.get_or_update_from_api_data(self.resource)
 
     def get_resource(self):
+        if hasattr(self, "_resource_cache"):
+            # Loaded by prefetch_resources(); None if it's not in the db
+            return self._resource_cache
         cls = self.resource_model
+        if cls is None:
+            return None
         return cls.objects.get(**{cls.id_field_name: self.resource_id})
 
-    def send_signal(self, created=None):
+    def send_signal(self, created=None, robust=PAYPAL_SUBS_WEBHOOK_ROBUST_HANDLERS):
+        """
+        Run the webhook handlers of this event, then the receivers connected
+        to its signal, and return their outcomes (see WebhookDispatcher).
+        """
         event_type = self.event_type.lower()
         signal = WEBHOOK_SIGNALS.get(event_type)
+        outcomes = webhook_dispatcher.dispatch(
+            event_type, robust=robust,
+            signal=signal, sender=self.__class__, event=self, created=created
+        )
         if signal:
-            signal.send(sender=self.__class__, event=self, created=created)
+            # Receivers connected to the signal directly
+            outcomes += webhook_dispatcher.send(
+                signal, self.__class__, robust=robust, event=self, created=created
+            )
+        return outcomes
 
 
 class WebhookEventTrigger(models.Model):
@@ -246,11 +301,25 @@ class WebhookEventTrigger(models.Model):
         help_text="IP address of the request client."
     )
     headers = JSONField()
+    transmission_id = models.CharField(
+        max_length=128, unique=True, null=True, blank=True, editable=False,
+        help_text="The paypal-transmission-id header, used to detect redeliveries."
+    )
     body = models.TextField(blank=True)
     valid = models.BooleanField(default=False)
     processed = models.BooleanField(default=False)
+    queued = models.BooleanField(
+        default=False, db_index=True,
+        help_text="Waiting to be verified and processed by a background worker."
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(null=True, blank=True, db_index=True)
     exception = models.CharField(max_length=128, blank=True)
     traceback = models.TextField(blank=True)
+    handler_outcomes = JSONField(
+        default=list, blank=True,
+        help_text="Outcome of every webhook handler run for the event."
+    )
     webhook_event = models.ForeignKey(
         "WebhookEvent", on_delete=models.SET_NULL, null=True, blank=True
     )
@@ -263,6 +332,9 @@ class WebhookEventTrigger(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
 
+    # Set on the placeholder triggers returned for suppressed duplicates
+    is_duplicate = False
+
     @classmethod
     def from_request(cls, request, webhook_id=PAYPAL_SUBS_WEBHOOK_ID):
         """
@@ -278,7 +350,22 @@ class WebhookEventTrigger(models.Model):
         2. Verify the WebhookEventTrigger as a Paypal webhook using the SDK.
         3. If valid, process it into a WebhookEvent object (and child resource).
         """
+        obj = cls.create_from_request(request)
+        if not obj.is_duplicate:
+            obj.verify_and_process(webhook_id)
+        return obj
 
+    @classmethod
+    def create_from_request(cls, request, **kwargs):
+        """
+        Store a WebhookEventTrigger for a Django request without verifying
+        or processing it.
+
+        Redeliveries of an already handled webhook (same transmission id, or
+        same event id as a processed trigger) are not stored again; see
+        find_duplicate(). Redeliveries of a trigger that failed return that
+        trigger, so that it's retried instead of stored twice.
+        """
         headers = fix_django_headers(request.META)
         assert headers
         try:
@@ -286,22 +373,177 @@ class WebhookEventTrigger(models.Model):
         except Exception:
             body = "(error decoding body)"
 
-        ip = request.META["REMOTE_ADDR"]
-        obj = cls.objects.create(headers=headers, body=body, remote_ip=ip)
+        transmission_id = headers.get("paypal-transmission-id") or None
+        existing = cls.find_duplicate(transmission_id, cls._extract_event_id(body))
+        if existing is None:
+            ip = request.META["REMOTE_ADDR"]
+            try:
+                with transaction.atomic():
+                    return cls.objects.create(
+                        headers=headers, body=body, remote_ip=ip,
+                        transmission_id=transmission_id, **kwargs
+                    )
+            except IntegrityError:
+                # The same transmission arrived concurrently
+                existing = cls.find_duplicate(transmission_id, None)
+                if existing is None:
+                    raise
+
+        if kwargs and not existing.is_duplicate:
+            for k, v in kwargs.items():
+                setattr(existing, k, v)
+            existing.save()
+        return existing
+
+    @staticmethod
+    def _extract_event_id(body):
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        return data.get("id") if isinstance(data, dict) else None
+
+    @classmethod
+    def find_duplicate(cls, transmission_id, event_id):
+        """
+        Look for a trigger that already handled this transmission or event.
+
+        Triggers that were processed (or are queued for it) are remembered
+        in a short-lived seen-set, so most duplicates are answered without a
+        query; for those, an unsaved placeholder with is_duplicate set is
+        returned, as it is for a trigger still being processed by
+        another request. A matching trigger that failed, or that has been in
+        flight for longer than PAYPAL_SUBS_WEBHOOK_IN_FLIGHT_TIMEOUT, is
+        returned as-is so that it's retried.
+        """
+        keys = [
+            "transmission:%s" % transmission_id if transmission_id else None,
+            "event:%s" % event_id if event_id else None,
+        ]
+        for key in keys:
+            pk = seen_webhooks.get(key)
+            if pk is not None:
+                return cls._duplicate_of(pk)
+
+        query = Q()
+        if transmission_id:
+            query |= Q(transmission_id=transmission_id)
+        if event_id:
+            query |= Q(webhook_event_id=event_id, processed=True)
+        if not query:
+            return None
+
+        existing = cls.objects.filter(query).order_by("-processed", "-queued").first()
+        if existing is None:
+            return None
+        if existing.processed or existing.queued:
+            existing.remember()
+            return cls._duplicate_of(existing.pk)
+        stale = now() - timedelta(seconds=PAYPAL_SUBS_WEBHOOK_IN_FLIGHT_TIMEOUT)
+        if existing.exception or existing.updated < stale:
+            return existing
+        # The first delivery is still being verified and processed
+        return cls._duplicate_of(existing.pk)
+
+    @classmethod
+    def _duplicate_of(cls, pk):
+        seen_webhooks.count_suppressed()
+        obj = cls(pk=pk, valid=True, processed=True)
+        obj.is_duplicate = True
+        return obj
+
+    def remember(self):
+        """Add this trigger's transmission and event ids to the seen-set"""
+        if self.transmission_id:
+            seen_webhooks.add("transmission:%s" % self.transmission_id, self.pk)
+        if self.webhook_event_id:
+            seen_webhooks.add("event:%s" % self.webhook_event_id, self.pk)
+
+    @classmethod
+    def enqueue_from_request(cls, request):
+        """
+        Store a WebhookEventTrigger for a Django request and queue it for
+        verification and processing by a background worker.
+
+        If settings.PAYPAL_SUBS_WEBHOOK_QUEUE_BACKEND names a callable, it is
+        called with the trigger id once the trigger is committed (e.g. to
+        schedule a task running `WebhookEventTrigger.process_queued(id)`).
+        Queued triggers are also picked up by the djpp_process_webhooks command.
+        """
+        obj = cls.create_from_request(request, queued=True, next_attempt=now())
+        if obj.is_duplicate:
+            return obj
+
+        obj.remember()
+        if PAYPAL_SUBS_WEBHOOK_QUEUE_BACKEND:
+            backend = import_string(PAYPAL_SUBS_WEBHOOK_QUEUE_BACKEND)
+            transaction.on_commit(lambda: backend(obj.pk))
+        return obj
+
+    @classmethod
+    def process_queued(cls, pk=None, webhook_id=PAYPAL_SUBS_WEBHOOK_ID):
+        """
+        Claim a queued trigger (the one with the given pk, or else the one
+        due the longest) and verify and process it.
 
+        Claimed rows stay locked until they're processed, and locked rows are
+        skipped, so any number of workers can run this concurrently.
+        Returns the trigger, or None if there was nothing to process.
+        """
+        with transaction.atomic():
+            queryset = cls.objects.select_for_update(skip_locked=True).filter(queued=True)
+            if pk is not None:
+                queryset = queryset.filter(pk=pk)
+            else:
+                queryset = queryset.filter(next_attempt__lte=now()).order_by("next_attempt", "id")
+
+            obj = queryset.first()
+            if obj is None:
+                return None
+
+            obj.attempts += 1
+            # Forget the previous attempt's error, so that it's not mistaken
+            # for a failure of this one
+            obj.exception = ""
+            obj.traceback = ""
+            obj.verify_and_process(webhook_id, save=False)
+            if obj.exception and obj.attempts < PAYPAL_SUBS_WEBHOOK_MAX_ATTEMPTS:
+                # Retry later, with exponential backoff
+                delay = PAYPAL_SUBS_WEBHOOK_RETRY_BACKOFF * 2 ** (obj.attempts - 1)
+                obj.next_attempt = now() + timedelta(seconds=delay)
+            else:
+                obj.queued = False
+                obj.next_attempt = None
+            obj.save()
+        return obj
+
+    def verify_and_process(self, webhook_id=PAYPAL_SUBS_WEBHOOK_ID, save=True, verify=True):
+        """
+        Verify the trigger and, if valid, process it. Exceptions are recorded
+        on the trigger instead of being raised.
+
+        With verify=False, the stored `valid` flag is trusted instead.
+        """
         try:
-            obj.valid = obj.verify(PAYPAL_SUBS_WEBHOOK_ID)
-            if obj.valid:
-                # Process the item (do not save it, it'll get saved below)
-                obj.process(save=False)
+            # Use a savepoint so that the trigger can still be saved if
+            # processing fails halfway through
+            with transaction.atomic():
+                if verify:
+                    self.valid = self.verify(webhook_id)
+                if self.valid:
+                    # Process the item (do not save it, it'll get saved below)
+                    self.process(save=False)
         except Exception as e:
             max_length = WebhookEventTrigger._meta.get_field("exception").max_length
-            obj.exception = str(e)[:max_length]
-            obj.traceback = format_exc()
-            webhook_error.send(sender=obj, exception=e)
+            self.exception = str(e)[:max_length]
+            self.traceback = format_exc()
+            webhook_error.send(sender=self, exception=e)
         finally:
-            obj.save()
-        return obj
+            if save:
+                self.save()
+        if self.processed and not self.exception:
+            self.remember()
+        return self
 
     @cached_property
     def data(self):
@@ -318,10 +560,6 @@ class WebhookEventTrigger(models.Model):
     def cert_url(self):
         return self.headers.get("paypal-cert-url", "")
 
-    @property
-    def transmission_id(self):
-        return self.headers.get("paypal-transmission-id", "")
-
     @property
     def transmission_sig(self):
         return self.headers.get("paypal-transmission-sig", "")
@@ -331,8 +569,18 @@ class WebhookEventTrigger(models.Model):
         return self.headers.get("paypal-transmission-time", "")
 
     def verify(self, webhook_id):
+        if PAYPAL_SUBS_WEBHOOK_VERIFY_LOCALLY:
+            return verify_webhook_signature(
+                transmission_id=self.headers.get("paypal-transmission-id", ""),
+                timestamp=self.transmission_time,
+                webhook_id=webhook_id,
+                event_body=self.body,
+                cert_url=self.cert_url,
+                actual_sig=self.transmission_sig,
+                auth_algo=self.auth_algo,
+            )
         return paypal_models.WebhookEvent.verify(
-            transmission_id=self.transmission_id,
+            transmission_id=self.headers.get("paypal-transmission-id", ""),
             timestamp=self.transmission_time,
             webhook_id=webhook_id,
             event_body=self.body,
@@ -343,6 +591,7 @@ class WebhookEventTrigger(models.Model):
 
     def process(self, save=True):
         self.webhook_event = WebhookEvent.process(self.data)
+        self.handler_outcomes = getattr(self.webhook_event, "handler_outcomes", [])
         self.processed = True
         self.exception = ""
         self.traceback = ""
@@ -351,9 +600,13 @@ class WebhookEventTrigger(models.Model):
         return self.webhook_event
 
 
-def webhook_handler(*event_types):
+def webhook_handler(*event_types, deferred=False):
     """
     Decorator that registers a function as a webhook handler.
+
+    Handlers registered with deferred=True run after the webhook has been
+    processed and committed, outside of the webhook request.
+
     Usage examples:
 
     >>> # Hook a single event
@@ -375,25 +628,70 @@ def webhook_handler(*event_types):
     >>>     print("Updated subscription:", subscription)
     """
 
-    # First expand all wildcards and verify the event types are valid
-    event_types_to_register = set()
+    # Verify the event types are valid; wildcards may match any event type
+    patterns = set()
     for event_type in event_types:
         # Always convert to lowercase
         event_type = event_type.lower()
-        if "*" in event_type:
-            # expand it
-            for t in WEBHOOK_EVENT_TYPES:
-                if fnmatch(t, event_type):
-                    event_types_to_register.add(t)
-        elif event_type not in WEBHOOK_EVENT_TYPES:
+        if "*" not in event_type and event_type not in WEBHOOK_EVENT_TYPES:
             raise ValueError("Unknown webhook event: %r" % (event_type))
-        else:
-            event_types_to_register.add(event_type)
+        patterns.add(event_type)
 
     # Now register them
     def decorator(func):
-        for event_type in event_types_to_register:
-            WEBHOOK_SIGNALS[event_type].connect(func)
+        for pattern in patterns:
+            webhook_dispatcher.register(pattern, func, deferred=deferred)
         return func
 
     return decorator
+
+
+def register_webhook_event_type(*event_types):
+    """
+    Make additional event types known, e.g. ones that PayPal introduced
+    after this release, so that handlers can be registered for them.
+    """
+    for event_type in event_types:
+        event_type = event_type.lower()
+        WEBHOOK_EVENT_TYPES.add(event_type)
+        if event_type not in WEBHOOK_SIGNALS:
+            WEBHOOK_SIGNALS[event_type] = Signal(providing_args=["event", "created"])
+
+
+# resource_type -> {resource_version: model}; None is the fallback version
+WEBHOOK_RESOURCE_MODELS = {}
+
+
+def webhook_resource(resource_type, version=None):
+    """
+    Class decorator that registers a model as the one used to store webhook
+    resources of the given type. Third-party apps can register their own
+    models, or override the default ones.
+
+    If `version` is given, the model is only used for resources with that
+    resource_version (or, for events without one, that event_version);
+    otherwise, it's used for all versions without a more specific
+    registration.
+
+    >>> @webhook_resource("invoice")
+    >>> class Invoice(PaypalModel):
+    >>>     ...
+    """
+    def decorator(model):
+        WEBHOOK_RESOURCE_MODELS.setdefault(resource_type.lower(), {})[version] = model
+        return model
+
+    return decorator
+
+
+def get_webhook_resource_model(resource_type, resource_version=None, event_version=None):
+    """
+    Return the model registered for resource_type and resource_version.
+    v1 events (e.g. billing.plan.*) have no resource_version, so their
+    event_version is used instead.
+    """
+    versions = WEBHOOK_RESOURCE_MODELS.get((resource_type or "").lower())
+    if not versions:
+        return None
+    version = resource_version or event_version or None
+    return versions.get(version) or versions.get(None)
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+from .settings import PAYPAL_SUBS_REMOTE_CACHE_SIZE, PAYPAL_SUBS_REMOTE_CACHE_TTL
+
+
+class RemoteObjectCache(object):
+    '''
+    A read-through, in-memory cache of objects fetched from the PayPal API,
+    keyed by (model, id, livemode).
+
+    Entries expire after `ttl` seconds and the least recently used ones are
+    dropped beyond `max_size` entries. Lookups are counted in `hits` and
+    `misses`. Entries are invalidated when a webhook for the object arrives
+    and after the object is changed through the API.
+
+    Invalidation only reaches this process's cache, so code that acts on the
+    object's state (e.g. cancelling an agreement) should pass fresh=True.
+    '''
+    def __init__(self, ttl=PAYPAL_SUBS_REMOTE_CACHE_TTL, max_size=PAYPAL_SUBS_REMOTE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._objects = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model, id, livemode, fetch, fresh=False):
+        '''
+        Returns the cached object, or calls fetch(id), caches its result
+        and returns it. With fresh=True the cached object is ignored and
+        replaced by the fetched one.
+        '''
+        key = (model, id, livemode)
+        with self._lock:
+            entry = self._objects.get(key)
+            if entry is not None and not fresh:
+                if entry[1] > time.time():
+                    self._objects.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._objects[key]
+            self.misses += 1
+
+        obj = fetch(id)
+        if self.ttl > 0:
+            with self._lock:
+                self._objects[key] = (obj, time.time() + self.ttl)
+                self._objects.move_to_end(key)
+                while len(self._objects) > self.max_size:
+                    self._objects.popitem(last=False)
+        return obj
+
+    def invalidate(self, model, id, livemode=None):
+        '''Drops the cached object, in both modes if livemode is None'''
+        modes = (True, False) if livemode is None else (livemode, )
+        with self._lock:
+            for mode in modes:
+                self._objects.pop((model, id, mode), None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._objects), 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+            self.hits = self.misses = 0
+
+
+remote_objects = RemoteObjectCache()
@@ -0,0 +1,98 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils.timezone import now
+
+from .settings import PAYPAL_SUBS_DEPENDENCY_TTL, PAYPAL_SUBS_SYNC_MAX_WORKERS
+
+
+class DependencyResolver(object):
+    '''
+    Makes sure that the parent objects referenced by incoming API resources
+    (e.g. the sale and payment of a refund) are in the db before the
+    resources themselves are written.
+
+    A model lists the foreign keys it depends on in `dependencies`. For a
+    batch of cleaned rows, the referenced ids are collected and loaded with
+    one query per parent model; only the missing ones, and those synced more
+    than `ttl` seconds ago, are fetched from the API, concurrently. Parents
+    are then written before their children, in one transaction.
+    '''
+    def __init__(self, ttl=PAYPAL_SUBS_DEPENDENCY_TTL, max_workers=PAYPAL_SUBS_SYNC_MAX_WORKERS):
+        self.ttl = ttl
+        self.max_workers = max_workers
+
+    @staticmethod
+    def dependencies(model):
+        '''Returns (attname, parent model) for each of model's dependencies'''
+        fields = [model._meta.get_field(name) for name in model.dependencies]
+        return [(field.attname, field.related_model) for field in fields]
+
+    def collect(self, model, rows):
+        '''Returns {parent model: set of ids} referenced by `rows`'''
+        ids = {}
+        for attname, parent in self.dependencies(model):
+            for data in rows:
+                if data.get(attname):
+                    ids.setdefault(parent, set()).add(data[attname])
+        return ids
+
+    def stale(self, model, ids):
+        '''Returns the ids of `model` that are missing or not fresh'''
+        fresh_since = now() - timedelta(seconds=self.ttl)
+        existing = model.objects.only('updated').in_bulk(ids)
+        return {
+            pk for pk in ids
+            if pk not in existing or existing[pk].updated < fresh_since
+        }
+
+    def resolve(self, model, rows, exclude=frozenset()):
+        '''
+        Returns the parents of `rows` (cleaned data dicts of `model`) that
+        have to be written, as a list of (model, [(pk, data), ...]),
+        grandparents before parents. (model, pk) pairs in `exclude` are
+        already being fetched.
+        '''
+        to_fetch = [
+            (parent, pk)
+            for parent, ids in self.collect(model, rows).items()
+            for pk in self.stale(parent, ids)
+            if (parent, pk) not in exclude
+        ]
+        if not to_fetch:
+            return []
+
+        with ThreadPoolExecutor(max_workers=max(self.max_workers, 1)) as executor:
+            fetched = list(executor.map(lambda args: args[0].fetch_paypal_object(args[1]), to_fetch))
+
+        rows_by_parent = {}
+        for (parent, pk), obj in zip(to_fetch, fetched):
+            pk, cleaned_data, m2ms = parent.api_cleaner(obj)
+            rows_by_parent.setdefault(parent, []).append((pk, cleaned_data))
+
+        exclude = exclude.union(to_fetch)
+        writes = []
+        for parent, parent_rows in rows_by_parent.items():
+            writes += self.resolve(parent, [data for pk, data in parent_rows], exclude)
+
+        # Parents that depend on nothing go first
+        for parent in sorted(rows_by_parent, key=lambda parent: len(parent.dependencies)):
+            writes.append((parent, [
+                (pk, parent.make_dict_with_defined_fields(data))
+                for pk, data in rows_by_parent[parent]
+            ]))
+        return writes
+
+    @staticmethod
+    def write(writes):
+        with transaction.atomic():
+            for model, rows in writes:
+                model.bulk_upsert(rows)
+
+    def ensure(self, model, rows):
+        '''Fetches and writes the missing or stale parents of `rows`'''
+        self.write(self.resolve(model, rows))
+
+
+dependency_resolver = DependencyResolver()
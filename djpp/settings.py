@@ -28,3 +28,80 @@ PAYPAL_SETTINGS = {
 if PAYPAL_SUBS_CLIENT_ID and PAYPAL_SUBS_SECRET:
     from paypalrestsdk import configure
     configure(PAYPAL_SETTINGS)
+
+# Pooled HTTP session used by djpp.api.PaypalApi
+PAYPAL_SUBS_API_POOL_SIZE   = getattr(settings, 'PAYPAL_SUBS_API_POOL_SIZE', 10)
+PAYPAL_SUBS_API_TIMEOUT     = getattr(settings, 'PAYPAL_SUBS_API_TIMEOUT', 30)  # seconds
+PAYPAL_SUBS_API_MAX_RETRIES = getattr(settings, 'PAYPAL_SUBS_API_MAX_RETRIES', 3)
+PAYPAL_SUBS_API_RETRY_BACKOFF = getattr(settings, 'PAYPAL_SUBS_API_RETRY_BACKOFF', 0.5)
+
+# OAuth token handling: tokens are refreshed this many seconds before they
+# expire (at most half their lifetime). Tokens returned without a usable
+# expires_in are kept for PAYPAL_SUBS_TOKEN_DEFAULT_TTL seconds.
+# Set PAYPAL_SUBS_TOKEN_CACHE to a django cache alias (e.g. 'default') to share
+# one token between all processes using that cache; a process holding the
+# fetch lock keeps it for at most PAYPAL_SUBS_TOKEN_LOCK_TIMEOUT seconds.
+PAYPAL_SUBS_TOKEN_REFRESH_MARGIN = getattr(settings, 'PAYPAL_SUBS_TOKEN_REFRESH_MARGIN', 300)
+PAYPAL_SUBS_TOKEN_DEFAULT_TTL = getattr(settings, 'PAYPAL_SUBS_TOKEN_DEFAULT_TTL', 600)
+PAYPAL_SUBS_TOKEN_CACHE = getattr(settings, 'PAYPAL_SUBS_TOKEN_CACHE', None)
+PAYPAL_SUBS_TOKEN_LOCK_TIMEOUT = getattr(settings, 'PAYPAL_SUBS_TOKEN_LOCK_TIMEOUT', 30)
+
+# Number of threads used to fetch object details in PaypalModel.init_from_api
+PAYPAL_SUBS_SYNC_MAX_WORKERS = getattr(settings, 'PAYPAL_SUBS_SYNC_MAX_WORKERS', 4)
+# Number of rows written per transaction by PaypalModel.bulk_upsert
+PAYPAL_SUBS_SYNC_BATCH_SIZE = getattr(settings, 'PAYPAL_SUBS_SYNC_BATCH_SIZE', 500)
+# Stored parent objects (e.g. the sale of a refund) synced less than this many
+# seconds ago are considered fresh and aren't fetched again from the API
+PAYPAL_SUBS_DEPENDENCY_TTL = getattr(settings, 'PAYPAL_SUBS_DEPENDENCY_TTL', 300)
+
+# Objects fetched from the API by find_and_sync and find_paypal_object are
+# kept in memory for this many seconds (0 disables caching), up to SIZE objects
+PAYPAL_SUBS_REMOTE_CACHE_TTL = getattr(settings, 'PAYPAL_SUBS_REMOTE_CACHE_TTL', 30)
+PAYPAL_SUBS_REMOTE_CACHE_SIZE = getattr(settings, 'PAYPAL_SUBS_REMOTE_CACHE_SIZE', 1000)
+
+# Number of threads used by admin actions that call the API for each
+# selected object (cancelling agreements, activating plans...)
+PAYPAL_SUBS_ADMIN_ACTION_WORKERS = getattr(settings, 'PAYPAL_SUBS_ADMIN_ACTION_WORKERS', 8)
+
+# Entitlements (see djpp.entitlements) of each user are cached for this many
+# seconds in the given django cache alias, if any
+PAYPAL_SUBS_ENTITLEMENT_CACHE = getattr(settings, 'PAYPAL_SUBS_ENTITLEMENT_CACHE', None)
+PAYPAL_SUBS_ENTITLEMENT_CACHE_TTL = getattr(settings, 'PAYPAL_SUBS_ENTITLEMENT_CACHE_TTL', 300)
+
+# Asynchronous webhook processing: when enabled, ProcessWebhookView only
+# stores the trigger and returns; triggers are verified and processed by the
+# djpp_process_webhooks command, or by the callable named in
+# PAYPAL_SUBS_WEBHOOK_QUEUE_BACKEND which receives the trigger id after commit
+PAYPAL_SUBS_WEBHOOK_ASYNC = getattr(settings, 'PAYPAL_SUBS_WEBHOOK_ASYNC', False)
+PAYPAL_SUBS_WEBHOOK_QUEUE_BACKEND = getattr(settings, 'PAYPAL_SUBS_WEBHOOK_QUEUE_BACKEND', None)
+PAYPAL_SUBS_WEBHOOK_MAX_ATTEMPTS = getattr(settings, 'PAYPAL_SUBS_WEBHOOK_MAX_ATTEMPTS', 5)
+PAYPAL_SUBS_WEBHOOK_RETRY_BACKOFF = getattr(settings, 'PAYPAL_SUBS_WEBHOOK_RETRY_BACKOFF', 60)  # seconds
+
+# Webhook signatures are verified locally against PayPal's certificate, which
+# is downloaded once per cert url and cached in memory (and on disk, if
+# PAYPAL_SUBS_CERT_CACHE_DIR is set). Certificates are only downloaded from
+# PAYPAL_SUBS_CERT_HOSTS. Set PAYPAL_SUBS_WEBHOOK_VERIFY_LOCALLY to False to
+# use paypalrestsdk's verification instead.
+PAYPAL_SUBS_WEBHOOK_VERIFY_LOCALLY = getattr(settings, 'PAYPAL_SUBS_WEBHOOK_VERIFY_LOCALLY', True)
+PAYPAL_SUBS_CERT_CACHE_DIR = getattr(settings, 'PAYPAL_SUBS_CERT_CACHE_DIR', None)
+PAYPAL_SUBS_CERT_HOSTS = getattr(settings, 'PAYPAL_SUBS_CERT_HOSTS',
+                                 ('api.paypal.com', 'api.sandbox.paypal.com'))
+
+# Webhook deduplication: transmission and event ids of handled webhooks are
+# remembered for this many seconds in memory, and in the given django cache
+# alias (if any) so that duplicates are recognised across processes.
+# A redelivery of a trigger that is still being processed is ignored, unless
+# the trigger was last touched more than IN_FLIGHT_TIMEOUT seconds ago (its
+# process probably died), in which case it's processed again.
+PAYPAL_SUBS_WEBHOOK_DEDUP_TTL = getattr(settings, 'PAYPAL_SUBS_WEBHOOK_DEDUP_TTL', 3600)
+PAYPAL_SUBS_WEBHOOK_DEDUP_CACHE = getattr(settings, 'PAYPAL_SUBS_WEBHOOK_DEDUP_CACHE', None)
+PAYPAL_SUBS_WEBHOOK_IN_FLIGHT_TIMEOUT = getattr(settings, 'PAYPAL_SUBS_WEBHOOK_IN_FLIGHT_TIMEOUT', 300)
+
+# Webhook handlers: with ROBUST_HANDLERS, an exception in one handler is
+# recorded and doesn't stop the others (like Signal.send_robust). Handlers
+# registered with @webhook_handler(..., deferred=True) run after the
+# transaction commits, in a pool of DEFERRED_WORKERS threads, or through the
+# callable named in DEFERRED_BACKEND, which receives (handler, kwargs)
+PAYPAL_SUBS_WEBHOOK_ROBUST_HANDLERS = getattr(settings, 'PAYPAL_SUBS_WEBHOOK_ROBUST_HANDLERS', False)
+PAYPAL_SUBS_WEBHOOK_DEFERRED_WORKERS = getattr(settings, 'PAYPAL_SUBS_WEBHOOK_DEFERRED_WORKERS', 4)
+PAYPAL_SUBS_WEBHOOK_DEFERRED_BACKEND = getattr(settings, 'PAYPAL_SUBS_WEBHOOK_DEFERRED_BACKEND', None)
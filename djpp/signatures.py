@@ -0,0 +1,159 @@
+import binascii
+import hashlib
+import os
+import threading
+from base64 import b64decode
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import requests
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.x509.oid import NameOID
+
+from .exceptions import WebhookCertificateError
+from .settings import PAYPAL_SUBS_API_TIMEOUT, PAYPAL_SUBS_CERT_CACHE_DIR, PAYPAL_SUBS_CERT_HOSTS
+
+AUTH_ALGORITHMS = {
+    'SHA256withRSA': hashes.SHA256,
+    'SHA1withRSA': hashes.SHA1,
+}
+
+
+def _not_valid_after(cert):
+    # not_valid_after_utc was added in cryptography 42
+    if hasattr(cert, 'not_valid_after_utc'):
+        return cert.not_valid_after_utc
+    return cert.not_valid_after.replace(tzinfo=timezone.utc)
+
+
+class CertificateStore(object):
+    '''
+    Downloads and caches the certificates PayPal signs webhooks with.
+
+    Certificates are cached in memory by url and, if `cache_dir` is set, on
+    disk, so they survive restarts. They're only ever downloaded over https
+    from `allowed_hosts`, and they're validated (common name, expiry and, if
+    `verify_chain` is set, the chain of trust shipped with paypalrestsdk)
+    once when loaded instead of on every webhook.
+    '''
+    def __init__(self, cache_dir=PAYPAL_SUBS_CERT_CACHE_DIR,
+                 allowed_hosts=PAYPAL_SUBS_CERT_HOSTS, verify_chain=True):
+        self.cache_dir = cache_dir
+        self.allowed_hosts = set(allowed_hosts)
+        self.verify_chain = verify_chain
+        self._certs = {}
+        self._lock = threading.Lock()
+
+    def check_url(self, url):
+        parsed = urlparse(url)
+        if parsed.scheme != 'https' or parsed.hostname not in self.allowed_hosts:
+            raise WebhookCertificateError('Untrusted certificate url: %r' % (url, ))
+
+    @staticmethod
+    def is_expired(cert):
+        return _not_valid_after(cert) <= datetime.now(timezone.utc)
+
+    def _cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest() + '.pem')
+
+    def _read(self, url):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_path(url), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, url, pem):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write to a temporary file first so readers never see partial files
+        path = self._cache_path(url)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(pem)
+        os.replace(tmp_path, path)
+
+    def _download(self, url):
+        r = requests.get(url, timeout=PAYPAL_SUBS_API_TIMEOUT)
+        r.raise_for_status()
+        return r.content
+
+    def validate(self, cert):
+        common_names = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+        if not common_names or not common_names[0].value.lower().endswith('.paypal.com'):
+            raise WebhookCertificateError('Certificate is not issued to paypal.com')
+        if self.is_expired(cert):
+            raise WebhookCertificateError('Certificate has expired')
+        if self.verify_chain:
+            from OpenSSL import crypto
+            from paypalrestsdk.notifications import WebhookEvent
+            if not WebhookEvent._verify_certificate_chain(crypto.X509.from_cryptography(cert)):
+                raise WebhookCertificateError('Certificate is not trusted')
+
+    def _load(self, url):
+        pem = self._read(url)
+        if pem is not None:
+            cert = x509.load_pem_x509_certificate(pem)
+            if not self.is_expired(cert):
+                return cert
+
+        pem = self._download(url)
+        cert = x509.load_pem_x509_certificate(pem)
+        self.validate(cert)
+        self._write(url, pem)
+        return cert
+
+    def get(self, url):
+        self.check_url(url)
+        cert = self._certs.get(url)
+        if cert is not None and not self.is_expired(cert):
+            return cert
+
+        with self._lock:
+            cert = self._certs.get(url)
+            if cert is None or self.is_expired(cert):
+                cert = self._certs[url] = self._load(url)
+        return cert
+
+    def clear(self):
+        with self._lock:
+            self._certs = {}
+
+
+certificate_store = CertificateStore()
+
+
+def get_expected_message(transmission_id, timestamp, webhook_id, event_body):
+    crc = binascii.crc32(event_body.encode('utf-8')) & 0xffffffff
+    return '{}|{}|{}|{}'.format(transmission_id, timestamp, webhook_id, crc).encode('utf-8')
+
+
+def verify_webhook_signature(transmission_id, timestamp, webhook_id, event_body,
+                             cert_url, actual_sig, auth_algo, store=certificate_store):
+    '''
+    Verifies the signature PayPal sent with a webhook, using a cached copy
+    of the signing certificate. Returns True or False, like
+    paypalrestsdk.notifications.WebhookEvent.verify.
+    '''
+    algorithm = AUTH_ALGORITHMS.get(auth_algo)
+    if algorithm is None:
+        return False
+
+    try:
+        cert = store.get(cert_url)
+        cert.public_key().verify(
+            b64decode(actual_sig),
+            get_expected_message(transmission_id, timestamp, webhook_id, event_body),
+            padding.PKCS1v15(),
+            algorithm(),
+        )
+    except (WebhookCertificateError, InvalidSignature, ValueError, binascii.Error,
+            requests.RequestException):
+        return False
+    return True
@@ -4,6 +4,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
 from .models import WebhookEventTrigger
+from .settings import PAYPAL_SUBS_WEBHOOK_ASYNC
 
 
 @method_decorator(csrf_exempt, name="dispatch")
@@ -17,6 +18,10 @@ class ProcessWebhookView(View):
     If the webhook cannot be verified, returns HTTP 400.
 
     If an exception happens during processing, returns HTTP 500.
+
+    With settings.PAYPAL_SUBS_WEBHOOK_ASYNC enabled, the WebhookEventTrigger
+    is only stored and queued, and HTTP 200 is returned right away;
+    verification and processing are left to a background worker.
     """
     def post(self, request):
         if "HTTP_PAYPAL_TRANSMISSION_ID" not in request.META:
@@ -24,6 +29,10 @@ class ProcessWebhookView(View):
             # no paypal transmission id so we avoid overfilling the db.
             return HttpResponseBadRequest()
 
+        if PAYPAL_SUBS_WEBHOOK_ASYNC:
+            trigger = WebhookEventTrigger.enqueue_from_request(request)
+            return HttpResponse(str(trigger.id))
+
         trigger = WebhookEventTrigger.from_request(request)
 
         if trigger.exception:
@@ -0,0 +1,34 @@
+'''
+Micro-benchmark of PaypalModel.make_dict_with_defined_fields on a Sale
+payload, which runs for every synced object.
+
+    python -m tests.bench_make_dict
+'''
+import os
+import timeit
+
+import django
+
+KEYS = [
+    'amount', 'payment_mode', 'state', 'reason_code', 'protection_eligibility',
+    'protection_eligibility_type', 'clearing_time', 'transaction_fee',
+    'receivable_amount', 'exchange_rate', 'receipt_id', 'parent_payment_id',
+    'soft_descriptor', 'create_time', 'update_time', 'links', 'livemode',
+    'undocumented_1', 'undocumented_2',
+]
+
+
+def main(number=20000, repeat=5):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    django.setup()
+    from djpp.models import Sale
+
+    def run():
+        Sale.make_dict_with_defined_fields({k: 1 for k in KEYS})
+
+    best = min(timeit.repeat(run, number=number, repeat=repeat))
+    print('make_dict_with_defined_fields: %.2f us/object' % (best / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
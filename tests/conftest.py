@@ -0,0 +1,8 @@
+import os
+
+import django
+
+
+def pytest_configure():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    django.setup()
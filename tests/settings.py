@@ -0,0 +1,23 @@
+# Minimal settings for the test suite. The tests don't touch the database,
+# so the postgres database doesn't have to exist.
+SECRET_KEY = 'tests'
+USE_TZ = True
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'djpp',
+]
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': 'djpp_tests',
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
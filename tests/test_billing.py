@@ -0,0 +1,111 @@
+from datetime import datetime, timezone
+from unittest import mock
+
+from dateutil.relativedelta import relativedelta
+
+from djpp.models import BillingAgreement, Entitlement
+from djpp.models.billing import NEVER_PAID_END_OF_PERIOD
+
+
+def regular(frequency, interval):
+    return {'type': 'REGULAR', 'frequency': frequency, 'frequency_interval': str(interval)}
+
+
+def agreement(pk, plan, last_payment_date='2020-01-15T10:00:00Z', end_of_period=None):
+    return BillingAgreement(
+        pk=pk, plan=plan, end_of_period=end_of_period,
+        agreement_details={'last_payment_date': last_payment_date} if last_payment_date else {},
+    )
+
+
+# v1 plans embedded in agreements usually don't have an id
+MONTHLY = {'payment_definitions': [
+    {'type': 'TRIAL', 'frequency': 'DAY', 'frequency_interval': '7'}, regular('Month', 1),
+]}
+YEARLY = {'payment_definitions': [regular('YEAR', 1)]}
+NO_REGULAR = {'payment_definitions': [
+    {'type': 'TRIAL', 'frequency': 'DAY', 'frequency_interval': '7'},
+]}
+
+
+def test_regular_delta_is_keyed_on_the_definition():
+    assert agreement(1, MONTHLY).get_regular_delta() == relativedelta(months=1)
+    assert agreement(2, YEARLY).get_regular_delta() == relativedelta(years=1)
+    # Memoized by (frequency, frequency_interval), whatever the plan
+    assert agreement(3, MONTHLY).get_regular_delta() is agreement(1, MONTHLY).get_regular_delta()
+
+
+def test_end_of_period():
+    paid = datetime(2020, 1, 15, 10, tzinfo=timezone.utc)
+    assert agreement(1, MONTHLY).calculate_end_of_period() == paid + relativedelta(months=1)
+    assert agreement(1, MONTHLY, None).calculate_end_of_period() == NEVER_PAID_END_OF_PERIOD
+    assert agreement(1, NO_REGULAR).get_regular_delta() is None
+    assert agreement(1, NO_REGULAR).calculate_end_of_period() is None
+
+
+class FakeQuerySet(list):
+    def only(self, *fields):
+        return self
+
+    def order_by(self, *fields):
+        return self
+
+    def filter(self, pk__gt):
+        return FakeQuerySet(obj for obj in self if obj.pk > pk__gt)
+
+
+def test_recompute_skips_agreements_without_regular_definition():
+    stored = datetime(2020, 2, 1, tzinfo=timezone.utc)
+    agreements = FakeQuerySet([
+        agreement(1, MONTHLY, end_of_period=stored),
+        agreement(2, NO_REGULAR, end_of_period=stored),
+        agreement(3, YEARLY, end_of_period=stored),
+    ])
+    manager = mock.Mock()
+    with mock.patch.object(BillingAgreement, 'objects', manager), \
+            mock.patch.object(type(Entitlement.objects), 'refresh'):
+        assert BillingAgreement.recompute_end_of_period(agreements, batch_size=2) == 2
+    updated = [obj.pk for call in manager.bulk_update.call_args_list for obj in call[0][0]]
+    assert updated == [1, 3]
+    assert agreements[1].end_of_period == stored
+
+
+def test_bulk_upsert_refreshes_display_prices():
+    from djpp.models import BillingPlan, PaymentDefinition
+
+    with mock.patch.object(BillingPlan, '_bulk_upsert_batch') as batch, \
+            mock.patch.object(BillingPlan, 'refresh_display_prices') as refresh:
+        BillingPlan.bulk_upsert([('P-1', {}), ('P-2', {})], batch_size=1)
+    assert batch.call_count == 2
+    queryset, = refresh.call_args[0]
+    assert 'IN (P-1, P-2)' in str(queryset.query)
+
+    # Changed payment definitions refresh the plans that use them
+    with mock.patch.object(PaymentDefinition, '_bulk_upsert_batch'), \
+            mock.patch.object(BillingPlan, 'refresh_display_prices') as refresh:
+        PaymentDefinition.bulk_upsert([('PD-1', {})])
+    queryset, = refresh.call_args[0]
+    assert 'payment_definitions' in str(queryset.query)
+
+
+def test_sync_data_refreshes_display_prices_after_setting_m2ms():
+    from djpp.models import BillingPlan, PaymentDefinition
+
+    calls = mock.Mock()
+    payload = {
+        'id': 'P-1', 'name': 'Plan', 'description': '', 'type': 'INFINITE',
+        'state': 'ACTIVE', 'merchant_preferences': {},
+        'payment_definitions': [dict(regular('MONTH', 1), id='PD-1')],
+    }
+    with mock.patch('djpp.models.base.transaction.atomic', mock.MagicMock()), \
+            mock.patch.object(BillingPlan, 'bulk_upsert', calls.bulk_upsert), \
+            mock.patch.object(PaymentDefinition.objects, 'sync_data', return_value=['PD-1']), \
+            mock.patch.object(BillingPlan.objects, 'set_m2m', calls.set_m2m), \
+            mock.patch.object(BillingPlan, 'finish_bulk_upsert', calls.finish_bulk_upsert):
+        assert BillingPlan.objects.sync_data([payload]) == ['P-1']
+    assert [name for name, args, kwargs in calls.mock_calls] == [
+        'bulk_upsert', 'set_m2m', 'finish_bulk_upsert',
+    ]
+    assert calls.bulk_upsert.call_args[1] == {'finish': False}
+    calls.set_m2m.assert_called_once_with('payment_definitions', {'P-1': ['PD-1']})
+    calls.finish_bulk_upsert.assert_called_once_with(['P-1'])
@@ -0,0 +1,93 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+from dateutil.parser import parse
+
+from djpp import cleaners
+from djpp.cleaners import ApiField, compile_cleaner, parse_datetime
+from djpp.models import BillingAgreement, PaymentDefinition, Plan
+
+
+class FakeModel(object):
+    _meta = SimpleNamespace(fields=[])
+    id_field_name = 'id'
+    api_fields = {
+        'email': ApiField(source='payer.email_address'),
+        'note': ApiField(source='status_note', default=''),
+        'quantity': ApiField(converter=int, default=list),
+    }
+
+    @staticmethod
+    def extract_livemode(data):
+        return None
+
+
+def test_parse_datetime():
+    assert parse_datetime('2020-01-02T03:04:05Z') == datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    assert parse_datetime('2020-01-02T03:04:05.123+00:00').microsecond == 123000
+    # Not ISO 8601, handled by dateutil
+    assert parse_datetime('Jan 2 2020 03:04:05 UTC').year == 2020
+    assert parse_datetime(None) is None
+
+
+def test_parse_datetime_without_fromisoformat():
+    # Python 3.6 has no datetime.fromisoformat
+    with mock.patch.object(cleaners, '_fromisoformat', parse):
+        assert parse_datetime('2020-01-02T03:04:05Z') == datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+        assert parse_datetime('2020-01-02T03:04:05.123Z').microsecond == 123000
+
+
+def test_declared_fields():
+    clean = compile_cleaner(FakeModel, livemode_default=True)
+    payload = {'id': 'X-1', 'payer': {'email_address': 'a@example.com'}, 'status_note': 'ok', 'quantity': '3'}
+    id, cleaned_data, m2ms = clean(payload)
+
+    assert id == 'X-1'
+    assert cleaned_data == {
+        'payer': {'email_address': 'a@example.com'},
+        'email': 'a@example.com', 'note': 'ok', 'quantity': 3, 'livemode': True,
+    }
+    assert m2ms == {}
+    # The payload itself is left alone
+    assert payload['quantity'] == '3'
+
+
+def test_missing_values():
+    clean = compile_cleaner(FakeModel, livemode_default=False)
+    id, cleaned_data, m2ms = clean({'id': 'X-1', 'payer': 'not a dict', 'quantity': None})
+
+    assert 'email' not in cleaned_data
+    assert cleaned_data['note'] == ''
+    # Explicit nulls are kept, not converted
+    assert cleaned_data['quantity'] is None
+    assert cleaned_data['livemode'] is False
+
+
+def test_datetime_fields_are_parsed():
+    id, cleaned_data, m2ms = Plan.api_cleaner({
+        'id': 'P-1', 'product_id': 'PROD-1',
+        'create_time': '2020-01-02T03:04:05Z', 'update_time': None,
+    })
+    assert id == 'P-1'
+    assert cleaned_data['create_time'] == datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    assert cleaned_data['update_time'] is None
+    assert cleaned_data['product_id'] == 'PROD-1'
+
+
+def test_livemode_from_links():
+    links = [{'href': 'https://api.sandbox.paypal.com/v1/payments/sale/S-1', 'rel': 'self'}]
+    id, cleaned_data, m2ms = Plan.api_cleaner({'id': 'P-1', 'links': links})
+    assert cleaned_data['livemode'] is False
+
+    links = [{'href': 'https://api.paypal.com/v1/payments/sale/S-1', 'rel': 'self'}]
+    id, cleaned_data, m2ms = Plan.api_cleaner({'id': 'P-1', 'links': links})
+    assert cleaned_data['livemode'] is True
+
+
+def test_model_declarations():
+    id, cleaned_data, m2ms = BillingAgreement.api_cleaner({'id': 'I-1', 'state': 'Canceled'})
+    assert cleaned_data['state'] == 'Cancelled'
+
+    id, cleaned_data, m2ms = PaymentDefinition.api_cleaner({'id': 'PD-1', 'frequency': 'Month'})
+    assert cleaned_data['frequency'] == 'MONTH'
@@ -0,0 +1,86 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import caches
+from django.utils.timezone import now
+
+from djpp.dedup import SeenSet
+from djpp.models import WebhookEventTrigger
+from djpp.models import webhooks
+
+
+def test_get_and_add():
+    seen = SeenSet(ttl=60, cache_alias=None)
+    assert seen.get('transmission:1') is None
+    seen.add('transmission:1', 42)
+    assert seen.get('transmission:1') == 42
+    # Empty keys are never remembered
+    seen.add('', 1)
+    assert seen.get('') is None
+
+
+def test_size_bound_drops_least_recently_used():
+    seen = SeenSet(ttl=60, cache_alias=None, max_size=2)
+    seen.add('a', 1)
+    seen.add('b', 2)
+    seen.get('a')
+    seen.add('c', 3)
+    assert seen.get('a') == 1
+    assert seen.get('b') is None
+    assert seen.get('c') == 3
+
+
+def test_expiry():
+    seen = SeenSet(ttl=-1, cache_alias=None)
+    seen.add('a', 1)
+    assert seen.get('a') is None
+
+
+def test_shared_cache():
+    caches['default'].clear()
+    SeenSet(ttl=60, cache_alias='default').add('event:WH-1', 7)
+    # Another process only sees it through the cache
+    assert SeenSet(ttl=60, cache_alias='default').get('event:WH-1') == 7
+    assert SeenSet(ttl=60, cache_alias=None).get('event:WH-1') is None
+
+
+def test_suppressed_counter():
+    seen = SeenSet(cache_alias=None)
+    seen.count_suppressed()
+    seen.count_suppressed()
+    assert seen.suppressed == 2
+    seen.clear()
+    assert seen.suppressed == 0
+
+
+def find_duplicate_of(stored):
+    manager = mock.Mock()
+    manager.filter.return_value.order_by.return_value.first.return_value = stored
+    with mock.patch.object(WebhookEventTrigger, 'objects', manager), \
+            mock.patch.object(webhooks, 'seen_webhooks', SeenSet(cache_alias=None)):
+        return WebhookEventTrigger.find_duplicate('T-1', 'WH-1')
+
+
+def stored_trigger(**kwargs):
+    kwargs.setdefault('updated', now())
+    return WebhookEventTrigger(pk=7, transmission_id='T-1', body='{}', **kwargs)
+
+
+def test_redelivery_of_in_flight_trigger_is_a_duplicate():
+    # Committed by the first delivery, which is still verifying/processing it
+    duplicate = find_duplicate_of(stored_trigger())
+    assert duplicate.is_duplicate
+    assert duplicate.pk == 7
+
+
+def test_redelivery_of_failed_or_stale_trigger_is_retried():
+    failed = stored_trigger(exception='KeyError')
+    assert find_duplicate_of(failed) is failed
+
+    abandoned = stored_trigger(updated=now() - timedelta(hours=1))
+    assert find_duplicate_of(abandoned) is abandoned
+
+
+def test_redelivery_of_processed_trigger_is_a_duplicate():
+    assert find_duplicate_of(stored_trigger(processed=True, valid=True)).is_duplicate
+    assert find_duplicate_of(None) is None
@@ -0,0 +1,135 @@
+from fnmatch import fnmatchcase
+
+import pytest
+from django.dispatch import Signal
+
+from djpp.dispatch import WebhookDispatcher
+from djpp.models.webhooks import WEBHOOK_EVENT_TYPES
+
+
+def make_handler(calls, name):
+    def handler(**kwargs):
+        calls.append((name, kwargs))
+    handler.__qualname__ = name
+    return handler
+
+
+def test_exact_and_wildcard_patterns():
+    dispatcher = WebhookDispatcher()
+    calls = []
+    exact = make_handler(calls, 'exact')
+    segment = make_handler(calls, 'segment')
+    tail = make_handler(calls, 'tail')
+    other = make_handler(calls, 'other')
+    dispatcher.register('billing.subscription.created', exact)
+    dispatcher.register('billing.*.created', segment)
+    dispatcher.register('billing.*', tail)
+    dispatcher.register('payment.sale.*', other)
+
+    assert dispatcher.resolve('billing.subscription.created') == (exact, segment, tail)
+    assert dispatcher.resolve('BILLING.SUBSCRIPTION.CREATED') == (exact, segment, tail)
+    assert dispatcher.resolve('billing.plan.updated') == (tail, )
+    assert dispatcher.resolve('payment.sale.completed') == (other, )
+    assert dispatcher.resolve('payment.sale') == ()
+    assert dispatcher.resolve('customer.dispute.created') == ()
+
+
+def test_wildcards_match_like_fnmatch():
+    # A wildcard before the last segment also spans several segments
+    patterns = ['*.created', 'billing.*.created', 'payment.*', '*sale*', 'billing.*d']
+    dispatcher = WebhookDispatcher()
+    handlers = {}
+    for pattern in patterns:
+        handlers[pattern] = make_handler([], pattern)
+        dispatcher.register(pattern, handlers[pattern])
+
+    for event_type in WEBHOOK_EVENT_TYPES:
+        expected = {
+            handlers[pattern] for pattern in patterns if fnmatchcase(event_type.lower(), pattern)
+        }
+        assert set(dispatcher.resolve(event_type)) == expected, event_type
+    assert handlers['*.created'] in dispatcher.resolve('billing.plan.created')
+
+
+def test_handlers_are_unique_and_in_registration_order():
+    dispatcher = WebhookDispatcher()
+    calls = []
+    first = make_handler(calls, 'first')
+    second = make_handler(calls, 'second')
+    dispatcher.register('billing.*', second)
+    dispatcher.register('billing.subscription.*', first)
+    dispatcher.register('billing.subscription.created', second)
+
+    assert dispatcher.resolve('billing.subscription.created') == (second, first)
+
+
+def test_register_invalidates_resolved_handlers():
+    dispatcher = WebhookDispatcher()
+    calls = []
+    handler = make_handler(calls, 'handler')
+    assert dispatcher.resolve('billing.plan.created') == ()
+
+    dispatcher.register('billing.plan.created', handler)
+    assert dispatcher.resolve('billing.plan.created') == (handler, )
+
+
+def test_dispatch_calls_handlers_and_records_latency():
+    dispatcher = WebhookDispatcher()
+    calls = []
+    handler = make_handler(calls, 'handler')
+    dispatcher.register('billing.plan.created', handler)
+
+    outcomes = dispatcher.dispatch('billing.plan.created', event='event')
+    assert calls == [('handler', {'event': 'event'})]
+    assert [outcome['status'] for outcome in outcomes] == ['ok']
+    assert list(dispatcher.latency().values())[0]['calls'] == 1
+
+    dispatcher.reset_latency()
+    assert dispatcher.latency() == {}
+
+
+def test_robust_dispatch_records_errors():
+    errors = []
+    dispatcher = WebhookDispatcher(on_error=lambda handler, e, kwargs: errors.append(e))
+    calls = []
+
+    def failing(**kwargs):
+        raise ValueError('boom')
+
+    dispatcher.register('billing.plan.created', failing)
+    dispatcher.register('billing.plan.created', make_handler(calls, 'after'))
+
+    with pytest.raises(ValueError):
+        dispatcher.dispatch('billing.plan.created')
+    assert calls == []
+
+    outcomes = dispatcher.dispatch('billing.plan.created', robust=True)
+    assert [outcome['status'] for outcome in outcomes] == ['error', 'ok']
+    assert outcomes[0]['error'] == 'ValueError: boom'
+    assert len(calls) == 1
+    assert len(errors) == 1
+
+
+def test_signal_receivers_outcomes():
+    errors = []
+    dispatcher = WebhookDispatcher(on_error=lambda handler, e, kwargs: errors.append((e, kwargs)))
+    signal = Signal(providing_args=['event'])
+    calls = []
+
+    def failing(**kwargs):
+        raise ValueError('boom')
+
+    signal.connect(failing, weak=False)
+    signal.connect(make_handler(calls, 'after'), weak=False)
+
+    outcomes = dispatcher.send(signal, 'sender', robust=True, event='event')
+    assert [(o['status'], o.get('error')) for o in outcomes] == [
+        ('error', 'ValueError: boom'), ('ok', None),
+    ]
+    assert len(calls) == 1
+    exception, kwargs = errors[0]
+    assert str(exception) == 'boom'
+    assert kwargs == {'sender': 'sender', 'event': 'event'}
+
+    with pytest.raises(ValueError):
+        dispatcher.send(signal, 'sender', event='event')
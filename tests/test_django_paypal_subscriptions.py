@@ -1,5 +1,5 @@
-from django_paypal_subscriptions import __version__
+from djpp import __version__
 
 
 def test_version():
-    assert __version__ == '0.1.0'
+    assert __version__ == '0.3.11'
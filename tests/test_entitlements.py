@@ -0,0 +1,125 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from django.db import models
+
+from djpp import entitlements
+from djpp.models import BillingAgreement, Entitlement, Subscription
+from djpp.models.payer import PayerManager
+
+END_OF_PERIOD = datetime.now(timezone.utc) + timedelta(days=3)
+
+
+def make_agreement(**kwargs):
+    fields = dict(
+        id='I-1', user_id=5, state='Active', plan={'id': 'P-1', 'payment_definitions': []},
+        livemode=False, agreement_details={}, payer={}, end_of_period=END_OF_PERIOD,
+    )
+    fields.update(kwargs)
+    return BillingAgreement(**fields)
+
+
+def test_agreement_entitlement():
+    entitlement = Entitlement.objects.entitlement_for(make_agreement())
+    assert entitlement.user_id == 5
+    assert entitlement.plan_id == 'P-1'
+    assert entitlement.is_active
+    assert entitlement.active_until == END_OF_PERIOD
+
+    assert Entitlement.objects.entitlement_for(make_agreement(user_id=None)) is None
+
+
+def test_agreement_states():
+    def is_active(state):
+        return Entitlement.objects.entitlement_for(make_agreement(state=state)).is_active
+
+    # Paid until end_of_period
+    assert is_active('Active')
+    assert is_active('Cancelled')
+    assert is_active('Completed')
+    assert not is_active('Suspended')
+    assert not is_active('Pending')
+    assert not is_active(None)
+
+
+def test_unknown_livemode():
+    entitlement = Entitlement.objects.entitlement_for(make_agreement(livemode=None))
+    assert entitlement.livemode is None
+    assert Entitlement._meta.get_field('livemode').null
+
+
+def test_subscription_entitlement():
+    subscription = Subscription(
+        id='S-1', plan_id='P-2', status='ACTIVE', livemode=True, subscriber={'payer_id': 'PAYER'}
+    )
+    entitlement = Entitlement.objects.entitlement_for(subscription, {'PAYER': 7})
+    assert (entitlement.user_id, entitlement.plan_id, entitlement.is_active) == (7, 'P-2', True)
+    assert entitlement.active_until is None
+
+    subscription.status = 'SUSPENDED'
+    assert not Entitlement.objects.entitlement_for(subscription, {'PAYER': 7}).is_active
+    assert Entitlement.objects.entitlement_for(subscription, {}) is None
+
+
+def test_agreement_save_refreshes_entitlement():
+    agreement = make_agreement()
+    callbacks = []
+    with mock.patch.object(models.Model, 'save'), \
+            mock.patch.object(PayerManager, 'link'), \
+            mock.patch('djpp.models.entitlements.transaction.on_commit', callbacks.append), \
+            mock.patch.object(type(Entitlement.objects), 'refresh') as refresh:
+        agreement.save()
+        assert len(callbacks) == 1
+        callbacks[0]()
+    refresh.assert_called_once_with(agreement)
+
+
+def test_refresh_on_commit_does_not_raise():
+    agreement = make_agreement()
+    with mock.patch('djpp.models.entitlements.transaction.on_commit', lambda f: f()), \
+            mock.patch.object(type(Entitlement.objects), 'refresh',
+                              side_effect=RuntimeError('unique violation')), \
+            mock.patch('djpp.models.entitlements.logger') as logger:
+        Entitlement.objects.refresh_on_commit(agreement)
+    assert logger.exception.called
+
+
+@contextmanager
+def fake_atomic(*args, **kwargs):
+    yield
+
+
+def test_refresh_is_conflict_safe():
+    # I-1 has no row yet, and another transaction inserts it concurrently:
+    # our insert is ignored and the row (pk 9) is updated instead
+    rows = [[], [(9, 'agreement', 'I-1')]]
+    queryset = mock.Mock()
+    queryset.filter.return_value.values_list.side_effect = lambda *fields: rows.pop(0)
+    manager = type(Entitlement.objects)
+    with mock.patch('djpp.models.entitlements.transaction.atomic', fake_atomic), \
+            mock.patch.object(manager, 'select_for_update', return_value=queryset), \
+            mock.patch.object(manager, 'bulk_create') as bulk_create, \
+            mock.patch.object(manager, 'bulk_update') as bulk_update, \
+            mock.patch.object(manager, 'invalidate') as invalidate:
+        entitlement, = Entitlement.objects.refresh(make_agreement())
+    assert bulk_create.call_args[1] == {'ignore_conflicts': True}
+    assert entitlement.pk == 9
+    assert bulk_update.call_args[0][0] == [entitlement]
+    invalidate.assert_called_once_with(5)
+
+
+def test_lookups_read_the_cache():
+    agreement = Entitlement.objects.entitlement_for(make_agreement())
+    expired = Entitlement.objects.entitlement_for(
+        make_agreement(id='I-2', end_of_period=datetime(2020, 1, 1, tzinfo=timezone.utc))
+    )
+    manager = Entitlement.objects
+    with mock.patch('djpp.models.entitlements.PAYPAL_SUBS_ENTITLEMENT_CACHE', 'default'):
+        manager.cache.set(manager.cache_prefix + '5', [agreement, expired])
+        try:
+            assert [e.source_id for e in entitlements.get_entitlements(5)] == ['I-1']
+            assert entitlements.has_active_plan(5, 'P-1')
+            assert not entitlements.has_active_plan(5, 'P-2')
+        finally:
+            manager.invalidate(5)
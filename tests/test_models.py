@@ -0,0 +1,104 @@
+from datetime import datetime, timezone
+
+from djpp.models import BillingPlan, Plan, Refund, Sale, WebhookEvent
+from djpp.resolver import DependencyResolver
+
+# Resource of a PAYMENT.SALE.COMPLETED webhook for a billing agreement payment
+SALE = {
+    'id': '80021663DE681814L',
+    'amount': {
+        'total': '1.00', 'currency': 'USD',
+        'details': {'subtotal': '1.00'},
+    },
+    'payment_mode': 'INSTANT_TRANSFER',
+    'state': 'completed',
+    'protection_eligibility': 'ELIGIBLE',
+    'protection_eligibility_type': 'ITEM_NOT_RECEIVED_ELIGIBLE,UNAUTHORIZED_PAYMENT_ELIGIBLE',
+    'transaction_fee': {'value': '0.33', 'currency': 'USD'},
+    'billing_agreement_id': 'I-PE7JWXKGVN0R',
+    'parent_payment': 'PAY-2SX87225LS497733JLFX2YDI',
+    'soft_descriptor': 'PAYPAL *TESTSTORE',
+    'create_time': '2017-01-17T22:30:26Z',
+    'update_time': '2017-01-17T22:30:49Z',
+    'links': [
+        {
+            'href': 'https://api.sandbox.paypal.com/v1/payments/sale/80021663DE681814L',
+            'rel': 'self', 'method': 'GET',
+        },
+        {
+            'href': 'https://api.sandbox.paypal.com/v1/payments/sale/80021663DE681814L/refund',
+            'rel': 'refund', 'method': 'POST',
+        },
+    ],
+}
+
+
+def test_clean_sale_payload():
+    id, cleaned_data, m2ms = Sale.api_cleaner(SALE)
+    data = Sale.make_dict_with_defined_fields(cleaned_data)
+
+    assert id == '80021663DE681814L'
+    assert data['parent_payment_id'] == 'PAY-2SX87225LS497733JLFX2YDI'
+    assert data['create_time'] == datetime(2017, 1, 17, 22, 30, 26, tzinfo=timezone.utc)
+    assert data['livemode'] is False
+    # The agreement isn't stored locally, so it must not be written into the
+    # billing_agreement foreign key
+    assert 'billing_agreement_id' not in data
+    assert 'billing_agreement' not in data
+    assert data['_extra_fields'] == {'billing_agreement_id': 'I-PE7JWXKGVN0R'}
+    # The payload isn't mutated
+    assert SALE['parent_payment'] == 'PAY-2SX87225LS497733JLFX2YDI'
+
+
+def test_sale_dependencies():
+    id, cleaned_data, m2ms = Sale.api_cleaner(SALE)
+    resolver = DependencyResolver()
+    collected = resolver.collect(Sale, [cleaned_data])
+    assert {model.__name__: ids for model, ids in collected.items()} == {
+        'Payment': {'PAY-2SX87225LS497733JLFX2YDI'},
+    }
+
+
+def test_refund_field_names():
+    assert {'sale_id', 'parent_payment_id'} <= Refund._field_name_set
+    assert 'billing_agreement_id' not in Sale._field_name_set
+
+
+# A BILLING.PLAN.CREATED webhook for a v1 billing plan: no resource_version
+PLAN_EVENT = {
+    'id': 'WH-9FE9644311463722U-6TR22899JY792883B',
+    'create_time': '2016-04-28T11:21:44Z',
+    'resource_type': 'plan',
+    'event_type': 'BILLING.PLAN.CREATED',
+    'summary': 'A billing plan was created',
+    'event_version': '1.0',
+    'resource': {
+        'id': 'P-7LT50814996943336LSNDODY',
+        'state': 'CREATED',
+        'name': 'Fast Speed Plan',
+        'description': 'Vanilla Tier',
+        'type': 'FIXED',
+        'merchant_preferences': {'auto_bill_amount': 'YES'},
+        'payment_definitions': [],
+        'create_time': '2016-04-28T11:21:41.151Z',
+        'update_time': '2016-04-28T11:21:41.151Z',
+        'links': [{
+            'href': 'https://api.sandbox.paypal.com/v1/payments/billing-plans/P-7LT50814996943336LSNDODY',
+            'rel': 'self', 'method': 'GET',
+        }],
+    },
+    'links': [],
+}
+
+
+def test_v1_plan_event_resource_model():
+    id, cleaned_data, m2ms = WebhookEvent.clean_api_data(PLAN_EVENT)
+    assert cleaned_data['resource_id'] == 'P-7LT50814996943336LSNDODY'
+
+    event = WebhookEvent(id=id, **WebhookEvent.make_dict_with_defined_fields(cleaned_data))
+    assert event.resource_version == ''
+    assert event.resource_model is BillingPlan
+
+    # v2 plans carry their resource_version
+    event.resource_version = '2.0'
+    assert event.resource_model is Plan
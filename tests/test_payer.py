@@ -0,0 +1,66 @@
+from unittest import mock
+
+import pytest
+
+from djpp.models import BillingAgreement, CheckoutOrder, Payer
+from djpp.models.payer import PayerManager
+
+AGREEMENT_PAYER = {'payer_info': {
+    'payer_id': 'PAYER1', 'email': 'buyer@example.com',
+    'first_name': 'Ada', 'last_name': 'Lovelace',
+}}
+ORDER_PAYER = {
+    'payer_id': 'PAYER1', 'email_address': 'buyer@example.com',
+    'name': {'given_name': 'Ada', 'surname': 'Lovelace'},
+}
+
+
+def agreement(user_id=5):
+    return BillingAgreement(id='I-1', payer=AGREEMENT_PAYER, user_id=user_id, livemode=False)
+
+
+def order():
+    return CheckoutOrder(id='O-1', payer=ORDER_PAYER, livemode=False)
+
+
+def test_hash_is_the_same_for_agreements_and_orders():
+    assert Payer.objects._payer_fields(agreement()) == Payer.objects._payer_fields(order())
+    assert Payer.objects._user_fields(agreement()) == {'user_id': 5}
+    assert Payer.objects._user_fields(order()) == {}
+
+
+@pytest.fixture
+def stored_payer():
+    '''Patches Payer.objects.filter() to find PAYER1, stored by agreement()'''
+    payer_id, fields, content_hash = Payer.objects._payer_fields(agreement())
+    queryset = mock.Mock()
+    queryset.values_list.return_value.first.return_value = (content_hash, 5)
+    with mock.patch.object(PayerManager, 'filter', return_value=queryset):
+        yield queryset
+
+
+def test_unchanged_payer_is_not_written(stored_payer):
+    # An order of the same payer doesn't rewrite it, nor clears its user
+    assert Payer.objects.link(order()) == 'PAYER1'
+    assert Payer.objects.link(agreement()) == 'PAYER1'
+    assert not stored_payer.update.called
+
+
+def test_changed_user_is_written(stored_payer):
+    Payer.objects.link(agreement(user_id=6))
+    stored_payer.update.assert_called_once_with(updated=mock.ANY, user_id=6)
+
+
+def test_link_all_compares_user_separately():
+    payer_id, fields, content_hash = Payer.objects._payer_fields(agreement())
+    stored = Payer(id='PAYER1', content_hash=content_hash, user_id=5, **fields)
+    with mock.patch.object(PayerManager, 'in_bulk', return_value={'PAYER1': stored}), \
+            mock.patch.object(PayerManager, 'bulk_update') as bulk_update:
+        Payer.objects.link_all([order()])
+        Payer.objects.link_all([agreement()])
+        assert not bulk_update.called
+
+        Payer.objects.link_all([agreement(user_id=6)])
+    (payer, ), update_fields = bulk_update.call_args[0]
+    assert payer.user_id == 6
+    assert update_fields == {'content_hash', 'updated', 'user'}
@@ -0,0 +1,50 @@
+from contextlib import contextmanager
+from unittest import mock
+
+import pytest
+
+from djpp.models import WebhookEventTrigger
+from djpp.models import webhooks
+
+
+@contextmanager
+def fake_atomic(*args, **kwargs):
+    yield
+
+
+@pytest.fixture
+def trigger():
+    trigger = WebhookEventTrigger(
+        pk=1, remote_ip='127.0.0.1', headers={}, body='{}', queued=True, attempts=1,
+        exception='HTTPError', traceback='Traceback (most recent call last): ...',
+    )
+    manager = mock.Mock()
+    manager.select_for_update.return_value.filter.return_value.filter.return_value \
+        .first.return_value = trigger
+    with mock.patch.object(webhooks.transaction, 'atomic', fake_atomic), \
+            mock.patch.object(WebhookEventTrigger, 'objects', manager), \
+            mock.patch.object(WebhookEventTrigger, 'save'), \
+            mock.patch.object(WebhookEventTrigger, 'remember'):
+        yield trigger
+
+
+def test_retry_clears_previous_exception(trigger):
+    # The retry fails verification without raising: the old exception must
+    # not make it look like a failure that has to be retried again
+    with mock.patch.object(WebhookEventTrigger, 'verify', return_value=False):
+        assert WebhookEventTrigger.process_queued(pk=1) is trigger
+    assert trigger.attempts == 2
+    assert trigger.exception == ''
+    assert trigger.traceback == ''
+    assert not trigger.valid
+    assert not trigger.queued
+    assert trigger.next_attempt is None
+
+
+def test_retry_is_rescheduled_on_error(trigger):
+    with mock.patch.object(WebhookEventTrigger, 'verify', side_effect=ValueError('boom')):
+        WebhookEventTrigger.process_queued(pk=1)
+    assert trigger.exception == 'boom'
+    assert 'ValueError' in trigger.traceback
+    assert trigger.queued
+    assert trigger.next_attempt is not None
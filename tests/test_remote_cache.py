@@ -0,0 +1,77 @@
+from djpp.remote_cache import RemoteObjectCache
+
+
+class Fetcher(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, id):
+        self.calls.append(id)
+        return {'id': id, 'version': len(self.calls)}
+
+
+def test_read_through():
+    cache = RemoteObjectCache(ttl=60, max_size=10)
+    fetch = Fetcher()
+    assert cache.get('Sale', 'S-1', False, fetch) == {'id': 'S-1', 'version': 1}
+    assert cache.get('Sale', 'S-1', False, fetch) == {'id': 'S-1', 'version': 1}
+    # Keyed by model, id and livemode
+    cache.get('Sale', 'S-1', True, fetch)
+    cache.get('Refund', 'S-1', False, fetch)
+    assert fetch.calls == ['S-1', 'S-1', 'S-1']
+    assert cache.stats() == {'size': 3, 'hits': 1, 'misses': 3}
+
+
+def test_invalidate():
+    cache = RemoteObjectCache(ttl=60, max_size=10)
+    fetch = Fetcher()
+    cache.get('Sale', 'S-1', False, fetch)
+    cache.get('Sale', 'S-1', True, fetch)
+    cache.invalidate('Sale', 'S-1')
+    assert cache.stats()['size'] == 0
+
+    cache.get('Sale', 'S-1', False, fetch)
+    assert cache.get('Sale', 'S-1', False, fetch)['version'] == 3
+
+
+def test_ttl_and_size_bound():
+    fetch = Fetcher()
+    disabled = RemoteObjectCache(ttl=0, max_size=10)
+    disabled.get('Sale', 'S-1', False, fetch)
+    disabled.get('Sale', 'S-1', False, fetch)
+    assert len(fetch.calls) == 2
+
+    cache = RemoteObjectCache(ttl=60, max_size=2)
+    for id in ('S-1', 'S-2', 'S-3'):
+        cache.get('Sale', id, False, fetch)
+    assert cache.stats()['size'] == 2
+    cache.get('Sale', 'S-1', False, fetch)
+    assert fetch.calls[-1] == 'S-1'
+
+    cache.clear()
+    assert cache.stats() == {'size': 0, 'hits': 0, 'misses': 0}
+
+
+def test_fresh_bypasses_and_replaces_entry():
+    cache = RemoteObjectCache(ttl=60, max_size=10)
+    fetch = Fetcher()
+    cache.get('Sale', 'S-1', False, fetch)
+    assert cache.get('Sale', 'S-1', False, fetch, fresh=True)['version'] == 2
+    # The fresh object replaces the cached one
+    assert cache.get('Sale', 'S-1', False, fetch)['version'] == 2
+    assert len(fetch.calls) == 2
+
+
+def test_state_changes_fetch_fresh_objects():
+    from unittest import mock
+    from djpp.models import BillingAgreement
+    from djpp.remote_cache import remote_objects
+
+    agreement = BillingAgreement(id='I-1', livemode=False)
+    remote = mock.Mock()
+    with mock.patch.object(remote_objects, 'get', return_value=remote) as get, \
+            mock.patch.object(BillingAgreement, 'get_or_update_from_api_data',
+                              return_value=(agreement, False)):
+        agreement.suspend('note')
+    assert get.call_args[1] == {'fresh': True}
+    remote.suspend.assert_called_once_with({'note': 'note'})
@@ -0,0 +1,77 @@
+import json
+import threading
+from datetime import datetime
+from unittest import mock
+
+from django.utils import timezone
+
+from djpp.management.commands import djpp_replay_webhooks
+from djpp.management.commands.djpp_replay_webhooks import Command, parse_aware
+
+
+class FakeTrigger(object):
+    def __init__(self, pk, resource_id, fail=None):
+        self.pk = pk
+        self.valid = True
+        self.exception = ''
+        self.body = json.dumps({
+            'event_type': 'PAYMENT.SALE.COMPLETED', 'resource': {'id': resource_id},
+        })
+        self.fail = fail
+        self.processed_by = None
+
+    @property
+    def data(self):
+        return json.loads(self.body)
+
+    def verify_and_process(self, webhook_id, verify=True):
+        self.processed_by = threading.current_thread()
+        if self.fail == 'raise':
+            # e.g. the save() at the end of processing failing
+            raise RuntimeError('connection lost')
+        if self.fail == 'exception':
+            self.exception = 'KeyError'
+
+
+def run(triggers, **options):
+    queryset = mock.Mock()
+    queryset.iterator.return_value = iter(triggers)
+    defaults = dict(
+        event_types=[], workers=2, reverify=False, chunk_size=1,
+        since=None, until=None, valid=None, processed=None, failed=False,
+    )
+    defaults.update(options)
+    with mock.patch.object(Command, 'get_queryset', return_value=queryset), \
+            mock.patch.object(djpp_replay_webhooks, 'print') as printed:
+        Command().handle(**defaults)
+    return [call[0][0] for call in printed.call_args_list]
+
+
+def test_replay_survives_worker_errors():
+    # chunk_size=1 makes the queues fill up immediately: a dead worker would
+    # block the main thread forever
+    triggers = [FakeTrigger(i, 'R-%d' % (i % 3), fail='raise' if i % 2 else None)
+                for i in range(20)]
+    lines = run(triggers)
+    assert lines[0].startswith('# Replayed 20 triggers')
+    assert '10 processed, 0 invalid, 10 failed' in lines[0]
+    assert 'Trigger 1 failed: connection lost' in lines[1:]
+    assert all(trigger.processed_by is not None for trigger in triggers)
+
+
+def test_replay_pins_resources_to_a_worker():
+    triggers = [FakeTrigger(i, 'R-%d' % (i % 3)) for i in range(12)]
+    triggers[4].fail = 'exception'
+    lines = run(triggers, workers=3)
+    assert '11 processed, 0 invalid, 1 failed' in lines[0]
+    for resource in range(3):
+        threads = {t.processed_by for t in triggers if t.pk % 3 == resource}
+        assert len(threads) == 1
+
+
+def test_parse_aware():
+    dt = parse_aware('2020-01-02 03:04')
+    assert timezone.is_aware(dt)
+    assert dt.replace(tzinfo=None) == datetime(2020, 1, 2, 3, 4)
+    dt = parse_aware('2020-01-02T03:04:00+02:00')
+    assert dt.utcoffset().total_seconds() == 7200
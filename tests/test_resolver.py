@@ -0,0 +1,70 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.utils.timezone import now
+
+from djpp.models import Payment, Refund, Sale
+from djpp.resolver import DependencyResolver
+
+PAYMENT = {'id': 'PAY-1', 'intent': 'sale', 'state': 'approved'}
+SALE = {'id': 'S-1', 'state': 'completed', 'parent_payment': 'PAY-1'}
+
+
+def stored(**objs):
+    '''Patches model.objects.only().in_bulk() to return the given objects'''
+    queryset = mock.Mock()
+    queryset.in_bulk.side_effect = lambda ids: {pk: obj for pk, obj in objs.items() if pk in ids}
+    return queryset
+
+
+def test_stale_ids():
+    resolver = DependencyResolver(ttl=300)
+    queryset = stored(**{
+        'S-fresh': Sale(updated=now()),
+        'S-old': Sale(updated=now() - timedelta(hours=1)),
+    })
+    with mock.patch.object(Sale.objects, 'only', return_value=queryset):
+        assert resolver.stale(Sale, {'S-fresh', 'S-old', 'S-missing'}) == {'S-old', 'S-missing'}
+
+
+def test_fresh_parents_are_not_fetched():
+    resolver = DependencyResolver(ttl=300)
+    queryset = stored(**{'PAY-1': Payment(updated=now())})
+    with mock.patch.object(Payment.objects, 'only', return_value=queryset), \
+            mock.patch.object(Payment, 'fetch_paypal_object') as fetch:
+        assert resolver.resolve(Sale, [{'parent_payment_id': 'PAY-1'}]) == []
+    assert not fetch.called
+
+
+def test_missing_parents_are_written_grandparents_first():
+    # A refund whose sale and payment are both missing: the sale refers to
+    # the same payment, which is fetched only once and written before it
+    resolver = DependencyResolver(ttl=300)
+    payloads = {'S-1': SALE, 'PAY-1': PAYMENT}
+    fetch = mock.Mock(side_effect=lambda id: payloads[id])
+    with mock.patch.object(Sale.objects, 'only', return_value=stored()), \
+            mock.patch.object(Payment.objects, 'only', return_value=stored()), \
+            mock.patch.object(Sale, 'fetch_paypal_object', fetch), \
+            mock.patch.object(Payment, 'fetch_paypal_object', fetch):
+        writes = resolver.resolve(Refund, [{'sale_id': 'S-1', 'parent_payment_id': 'PAY-1'}])
+
+    assert sorted(call[0][0] for call in fetch.call_args_list) == ['PAY-1', 'S-1']
+    assert [model for model, rows in writes] == [Payment, Sale]
+    (payment_pk, payment), = writes[0][1]
+    (sale_pk, sale), = writes[1][1]
+    assert (payment_pk, sale_pk) == ('PAY-1', 'S-1')
+    assert sale['parent_payment_id'] == 'PAY-1'
+
+
+def test_parent_of_parent_is_resolved_recursively():
+    resolver = DependencyResolver(ttl=300)
+    payloads = {'S-1': SALE, 'PAY-1': PAYMENT}
+    fetch = mock.Mock(side_effect=lambda id: payloads[id])
+    with mock.patch.object(Sale.objects, 'only', return_value=stored()), \
+            mock.patch.object(Payment.objects, 'only', return_value=stored()), \
+            mock.patch.object(Sale, 'fetch_paypal_object', fetch), \
+            mock.patch.object(Payment, 'fetch_paypal_object', fetch):
+        # Only the sale is referenced; its payment is found through it
+        writes = resolver.resolve(Refund, [{'sale_id': 'S-1'}])
+    assert [model for model, rows in writes] == [Payment, Sale]
+    assert fetch.call_count == 2
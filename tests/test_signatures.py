@@ -0,0 +1,89 @@
+from base64 import b64encode
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import NameOID
+
+from djpp.exceptions import WebhookCertificateError
+from djpp.signatures import CertificateStore, get_expected_message, verify_webhook_signature
+
+CERT_URL = 'https://api.paypal.com/v1/notifications/certs/CERT-360caa42'
+EVENT_BODY = '{"id": "WH-1", "event_type": "BILLING.SUBSCRIPTION.CREATED"}'
+
+
+def make_certificate(key, common_name='messageverificationcerts.paypal.com', days=1):
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.now(timezone.utc)
+    return (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key()).serial_number(1)
+        .not_valid_before(now - timedelta(days=2)).not_valid_after(now + timedelta(days=days))
+        .sign(key, hashes.SHA256())
+    )
+
+
+@pytest.fixture(scope='module')
+def key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture
+def store(key, tmp_path):
+    store = CertificateStore(cache_dir=str(tmp_path), verify_chain=False)
+    pem = make_certificate(key).public_bytes(serialization.Encoding.PEM)
+    store.downloads = []
+
+    def download(url):
+        store.downloads.append(url)
+        return pem
+    store._download = download
+    return store
+
+
+def verify(key, store, **kwargs):
+    message = get_expected_message('tid', '2020-01-01T00:00:00Z', 'WH-ID', EVENT_BODY)
+    signature = b64encode(key.sign(message, padding.PKCS1v15(), hashes.SHA256())).decode()
+    options = dict(
+        transmission_id='tid', timestamp='2020-01-01T00:00:00Z', webhook_id='WH-ID',
+        event_body=EVENT_BODY, cert_url=CERT_URL, actual_sig=signature,
+        auth_algo='SHA256withRSA', store=store,
+    )
+    options.update(kwargs)
+    return verify_webhook_signature(**options)
+
+
+def test_valid_signature(key, store):
+    assert verify(key, store)
+
+
+def test_tampered_or_untrusted_webhooks_are_rejected(key, store):
+    assert not verify(key, store, event_body=EVENT_BODY + ' ')
+    assert not verify(key, store, webhook_id='OTHER-ID')
+    assert not verify(key, store, actual_sig='not base64!')
+    assert not verify(key, store, auth_algo='MD5withRSA')
+    assert not verify(key, store, cert_url='https://example.com/cert')
+    assert not verify(key, store, cert_url='http://api.paypal.com/cert')
+
+
+def test_certificate_is_downloaded_once(key, store, tmp_path):
+    assert verify(key, store)
+    assert verify(key, store)
+    assert store.downloads == [CERT_URL]
+
+    # A new store (e.g. after a restart) reads the certificate from disk
+    other_store = CertificateStore(cache_dir=str(tmp_path), verify_chain=False)
+    other_store._download = None
+    assert verify(key, other_store)
+
+
+def test_certificate_validation(key):
+    store = CertificateStore(verify_chain=False)
+    store.validate(make_certificate(key))
+    with pytest.raises(WebhookCertificateError):
+        store.validate(make_certificate(key, common_name='paypal.com.example.com'))
+    with pytest.raises(WebhookCertificateError):
+        store.validate(make_certificate(key, days=-1))
@@ -0,0 +1,100 @@
+import threading
+import time
+
+from django.core.cache import caches
+
+import pytest
+
+from djpp.api import PaypalTokenManager
+
+
+KEY = ('client-id', False)
+
+
+class Fetcher(object):
+    def __init__(self, expires_in=32400, delay=0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+            n = self.calls
+        time.sleep(self.delay)
+        dic = {'access_token': 'token-%d' % n}
+        if self.expires_in is not None:
+            dic['expires_in'] = self.expires_in
+        return dic
+
+
+@pytest.fixture
+def cache():
+    cache = caches['default']
+    cache.clear()
+    yield cache
+    cache.clear()
+
+
+def test_reuses_token():
+    tokens = PaypalTokenManager(refresh_margin=300, cache_alias=None)
+    fetch = Fetcher()
+    assert tokens.get(KEY, fetch) == 'token-1'
+    assert tokens.get(KEY, fetch) == 'token-1'
+    assert fetch.calls == 1
+    # A rejected token is replaced
+    assert tokens.get(KEY, fetch, stale_token='token-1') == 'token-2'
+
+
+@pytest.mark.parametrize('expires_in', [None, 0, 'garbage', 60, 300])
+def test_short_or_missing_expiry_is_still_reused(expires_in):
+    tokens = PaypalTokenManager(refresh_margin=300, cache_alias=None, default_ttl=600)
+    fetch = Fetcher(expires_in=expires_in)
+    tokens.get(KEY, fetch)
+    tokens.get(KEY, fetch)
+    assert fetch.calls == 1
+
+
+def test_margin_is_clamped_to_half_the_lifetime():
+    tokens = PaypalTokenManager(refresh_margin=300, cache_alias=None)
+    before = time.time()
+    token, refresh_at = tokens._make_entry({'access_token': 'x', 'expires_in': 100})
+    assert before + 50 <= refresh_at <= time.time() + 50
+    token, refresh_at = tokens._make_entry({'access_token': 'x', 'expires_in': 32400})
+    assert before + 32100 <= refresh_at <= time.time() + 32100
+
+
+def test_shared_cache(cache):
+    fetch = Fetcher()
+    assert PaypalTokenManager(cache_alias='default').get(KEY, fetch) == 'token-1'
+    # Another process finds the token in the shared cache
+    assert PaypalTokenManager(cache_alias='default').get(KEY, fetch) == 'token-1'
+    assert fetch.calls == 1
+    assert cache.get(PaypalTokenManager.cache_key(KEY) + ':lock') is None
+
+
+def test_single_fetch_across_processes(cache):
+    # Separate managers stand in for separate processes sharing the cache
+    fetch = Fetcher(delay=0.3)
+    results = []
+
+    def run():
+        results.append(PaypalTokenManager(cache_alias='default').get(KEY, fetch))
+
+    threads = [threading.Thread(target=run) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert fetch.calls == 1
+    assert results == ['token-1'] * 5
+
+
+def test_lock_timeout(cache):
+    # A dead lock holder doesn't block the others forever
+    cache.add(PaypalTokenManager.cache_key(KEY) + ':lock', True, timeout=60)
+    fetch = Fetcher()
+    tokens = PaypalTokenManager(cache_alias='default', lock_timeout=0.3)
+    assert tokens.get(KEY, fetch) == 'token-1'
+    assert fetch.calls == 1